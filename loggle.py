@@ -3,15 +3,38 @@
 import sys
 import argparse
 import os
+import re
+import multiprocessing
+import shutil
+import tempfile
+import hashlib
+import json
+import locale
+import mmap
+import fnmatch
 from pathlib import Path
 
 FILE_TYPES = [".dart", ".py", ".cpp", ".c"] # list of supported file types to inspect.  you can change this if needed.
+EXCLUDE_DIRS = [".git", ".hg", ".svn", ".dart_tool", "build", "node_modules"] # directories that are never searched for target files.  you can change this if needed.
+EXCLUDES = [] # compiled .gitignore-style exclude patterns (see compile_exclude), from --exclude / --exclude-from.
 KEYS = ["import 'dart:developer';", "log(", "print(", "debugPrint("] # keys that lines must begin with for a line to be toggled (must begin with = ignoring whitespace, SELF_KEY, and comments.  you can change this if needed.
 # if a keys file is provided, it should be plaintext, 1 key per line.
 COMMENT_KEY = "//" # key signaling the beginning of a comment.  you can change this if needed.
 SELF_KEY = "cec339cd" # last 8 chars of whirlpool hash of "log toggled by loggle.py".  SELF_KEY is used to identify lines that have been toggled by loggle.py.  you can change this if needed.  ideally it should be a short, unique string to avoid false matches and maintain readability.  NOTE: after running this script in disable mode, if you remove this tag from a line it will not be found by this script and will not be re-enabled.
 TARGETS = [] # target files to operate on.
 HITS = set() # used for collecting the filenames of files containing at least one instance of a key in KEYS.
+CHANGED = set() # used for collecting the filenames of files that were (or in check mode, would be) rewritten.
+CHECK = False # check mode (dry run): find the files that would change, but don't write anything.
+STATS = {"read": 0, "rewritten": 0, "cached": 0} # number of target files read / rewritten / skipped because the cache shows they're already toggled during this run.
+KEY_PATTERN = None # compiled matcher for (encoded) lines beginning with a key in KEYS, set by compile_keys().
+TAG = None # encoded COMMENT_KEY + SELF_KEY tag inserted in front of disabled lines, set by compile_keys().
+ENABLE_NEEDLES = () # encoded SELF_KEY, a file must contain it to have anything to enable.  set by compile_keys().
+DISABLE_NEEDLES = () # encoded KEYS, a file must contain one of them to have anything to disable.  set by compile_keys().
+CHUNK_SIZE = 16 # number of target files handed to a worker at a time when running with --jobs.
+CACHE_FILENAME = ".loggle-cache" # default state cache file used with --cache.
+CACHE_VERSION = 1 # bump when the cache format or digest changes so old caches are discarded.
+ENCODING = locale.getpreferredencoding(False) # encoding KEYS, COMMENT_KEY and SELF_KEY are matched in (the open() default).  files are processed as raw bytes.
+COPY_SIZE = 1 << 16 # size in bytes of the blocks files are copied / hashed in.
 
 
 
@@ -25,6 +48,57 @@ def make_file_types_lc():
         FILE_TYPES[i] = FILE_TYPES[i].lower()
 
 
+def compile_exclude(pattern):
+    """
+    Compile a .gitignore-style exclude pattern.
+
+    A pattern ending in "/" only matches directories.
+    A pattern containing a "/" (other than a trailing one) is matched against the path relative to the target directory,
+    otherwise it is matched against the file / directory name at any depth.
+    Negated ("!") patterns aren't supported.
+
+    Return a tuple (regex, dir_only, anchored).
+    """
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    return re.compile(fnmatch.translate(pattern)), dir_only, anchored
+
+
+def parse_excludes(patterns):
+    """
+    Add the exclude patterns in the list patterns to EXCLUDES.
+    Blank patterns and comments ("#") are ignored.
+    """
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if pattern and not pattern.startswith("#"):
+            EXCLUDES.append(compile_exclude(pattern))
+
+
+def parse_exclude_file(fn):
+    """
+    Read in the exclude patterns listed in an exclude file (e.g. a .gitignore), 1 pattern per line.
+    """
+    with open(fn) as in_file:
+        parse_excludes(in_file)
+
+
+def is_excluded(rel_path, name, is_dir):
+    """
+    Return True if the file / directory at rel_path (relative to the target directory, "/" separated) matches an exclude pattern.
+    """
+    if is_dir and name in EXCLUDE_DIRS:
+        return True
+    for regex, dir_only, anchored in EXCLUDES:
+        if dir_only and not is_dir:
+            continue
+        if regex.match(rel_path if anchored else name):
+            return True
+    return False
+
+
 def parse_keys(fn):
     """
     Read in and set the KEYS listed in the keys file if a keys file is provided.
@@ -40,96 +114,421 @@ def parse_keys(fn):
         KEYS = data
 
 
-def parse_targets(fns):
+def make_key_trie(keys):
     """
-    Set TARGETS to the (absolute file paths) of the list of files provided and any files found recursively in any directories provided.
+    Return a prefix trie (nested dicts) of keys (byte strings).
+    A key ending at a node is marked by a None entry.
+    """
+    trie = {}
+    for k in keys:
+        node = trie
+        for c in k:
+            node = node.setdefault(c, {})
+        node[None] = {}
+    return trie
+
+
+def trie_to_regex(node):
+    """
+    Return a (bytes) regex matching any key in the trie rooted at node.
+
+    Any key that is a prefix of a longer key is enough for a line to match, so the longer keys are dropped.
+    Each level of the regex branches on a single byte, so matching a line doesn't get slower as keys are added.
+    """
+    if None in node:
+        return b""
+    branches = [re.escape(bytes([c])) + trie_to_regex(child) for c, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return b"(?:" + b"|".join(branches) + b")"
+
+
+def compile_keys():
+    """
+    Compile KEYS into a single matcher (KEY_PATTERN) and build the disabled line TAG.
+
+    KEY_PATTERN matches a line beginning with any key in KEYS (ignoring leading whitespace).
+    Group 1 of a match is the leading whitespace, which is where TAG is inserted.
+
+    Also set the byte strings files are prefiltered with (see prefilter_file).
+    """
+    global KEY_PATTERN, TAG, ENABLE_NEEDLES, DISABLE_NEEDLES
+    DISABLE_NEEDLES = tuple(k.encode(ENCODING) for k in KEYS)
+    ENABLE_NEEDLES = (SELF_KEY.encode(ENCODING),)
+    KEY_PATTERN = re.compile(rb"(\s*)" + trie_to_regex(make_key_trie(DISABLE_NEEDLES)))
+    TAG = (COMMENT_KEY + " " + SELF_KEY + " ").encode(ENCODING)
+
+
+def iter_targets(fns):
     """
-    global TARGETS
+    Yield the (absolute file paths) of the list of files provided and any files found recursively in any directories provided, as they are found.
+
+    Directories in EXCLUDE_DIRS and files / directories matching EXCLUDES are pruned, so excluded trees are never scanned.
+    A file reached more than once (through a symlink or another hard link) is only yielded the first time, so two
+    workers never toggle the same file at once.
+    """
+    file_types = set(FILE_TYPES)
+    seen = set() # (st_dev, st_ino) of the files yielded so far
     for f in fns:
         path = os.path.abspath(f)
         if os.path.isfile(path):
-            for ext in FILE_TYPES:
-                if path.lower().endswith(ext):
-                    TARGETS.append(path)
-                    break
+            if os.path.splitext(path)[1].lower() in file_types:
+                st = os.stat(path)
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    yield path
         elif os.path.isdir(path):
-            # subfiles = [os.path.join(dp, f) for dp, dn, filenames in os.walk(path) for f in filenames for ext in FILE_TYPES if f.lower().endswith(ext)]
-            subfiles = []
-            try:
-                for root, dirs, files in os.walk(path):
-                    for f in files:
-                        for ext in FILE_TYPES:
-                            if f.lower().endswith(ext):
-                                subfiles.append(os.path.join(root, f))
-                                break
-                TARGETS.extend(subfiles)
-            except:
-                print(getErrorMsgParsingTargets(path))
-
-
-def read_file(fn):
-    data = []
-    with open(fn) as in_file:
-        for line in in_file:
-            data.append(line)
-    return data
+            stack = [(path, "")]
+            while stack:
+                dn, rel_dn = stack.pop()
+                try:
+                    dev = os.stat(dn).st_dev
+                    with os.scandir(dn) as it:
+                        entries = list(it)
+                except OSError:
+                    print(getErrorMsgParsingTargets(dn))
+                    continue
+                for entry in entries:
+                    rel_path = rel_dn + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not is_excluded(rel_path, entry.name, True):
+                                stack.append((entry.path, rel_path + "/"))
+                        elif os.path.splitext(entry.name)[1].lower() in file_types and entry.is_file():
+                            if not is_excluded(rel_path, entry.name, False):
+                                # the inode of a symlink's target needs a stat, a plain entry's comes with the scan
+                                if entry.is_symlink():
+                                    st = entry.stat()
+                                    key = (st.st_dev, st.st_ino)
+                                else:
+                                    key = (dev, entry.inode())
+                                if key not in seen:
+                                    seen.add(key)
+                                    yield entry.path
+                    except OSError:
+                        print(getErrorMsgParsingTargets(entry.path))
+
+
+def parse_targets(fns):
+    """
+    Set TARGETS to the (absolute file paths) of the list of files provided and any files found recursively in any directories provided.
+    """
+    TARGETS.extend(iter_targets(fns))
+
+
+def copy_prefix(fn, out_file, size):
+    """
+    Copy the first size bytes of fn to out_file.
+    """
+    with open(fn, "rb") as in_file:
+        while size > 0:
+            block = in_file.read(min(size, COPY_SIZE))
+            if not block:
+                break
+            out_file.write(block)
+            size -= len(block)
 
 
-def write_file(fn, data):
-    with open(fn, "w") as out_file:
-        for line in data:
-            out_file.write(line)
+def update_file(fn, toggled_lines):
+    """
+    Stream the lines of fn through to a temp file and rename it over fn, if any line changed.
+
+    toggled_lines yields a tuple (line, new_line) for each line read from in_file.
+
+    Nothing is written until the first line that changes; the unchanged lines before it are copied from fn.
+    The temp file is in the same directory as the file fn resolves to (through symlinks) and is synced and renamed
+    over it once complete, so an interrupted run (or a crash) leaves either the old file or the new file, never a
+    partially written one.  A file with other hard links is written in place from the complete (and synced) temp file
+    instead, so the links keep sharing it: that write is NOT atomic, an interrupted run can leave such a file partially
+    written.  (iter_targets yields each file once, however many links to it are targets, so no two workers write it.)
+    Only one line is held in memory at a time.
+
+    Return a tuple (rewritten, digest):
+    rewritten is True if fn was rewritten (in check mode, if fn would be rewritten; nothing is written).
+    digest is the content digest of fn after toggling (None in check mode if fn would be rewritten).
+    """
+    h = hashlib.sha1()
+    offset = 0
+    for line, new_line in toggled_lines:
+        if new_line != line:
+            break
+        h.update(line)
+        offset += len(line)
+    else:
+        return False, h.hexdigest()
+    if CHECK:
+        return True, None
+    fn = os.path.realpath(fn) # write the file behind a symlink, not over the link
+    dn, bn = os.path.split(fn)
+    fd, tmp_fn = tempfile.mkstemp(prefix="." + bn + ".", suffix=".loggle", dir=dn)
+    try:
+        with open(fd, "w+b") as out_file:
+            copy_prefix(fn, out_file, offset)
+            h.update(new_line)
+            out_file.write(new_line)
+            for line, new_line in toggled_lines:
+                h.update(new_line)
+                out_file.write(new_line)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+            if os.stat(fn).st_nlink > 1:
+                # renaming would split fn off from its other hard links
+                out_file.seek(0)
+                with open(fn, "r+b") as fn_file:
+                    shutil.copyfileobj(out_file, fn_file, COPY_SIZE)
+                    fn_file.truncate()
+                os.remove(tmp_fn)
+                return True, h.hexdigest()
+        shutil.copymode(fn, tmp_fn)
+        os.replace(tmp_fn, fn)
+    except:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+    return True, h.hexdigest()
+
+
+def file_digest(fn):
+    """
+    Return the hex digest of the content of fn.
+    """
+    h = hashlib.sha1()
+    with open(fn, "rb") as in_file:
+        for block in iter(lambda: in_file.read(COPY_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def prefilter_file(fn, needles):
+    """
+    Search the raw bytes of fn for any of needles, without decoding or splitting it into lines.
+
+    Return None if fn contains at least one of needles (fn needs line level processing).
+    Otherwise fn can't have anything to toggle; return the content digest of fn.
+    """
+    with open(fn, "rb") as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return hashlib.sha1().hexdigest()
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for needle in needles:
+                if mm.find(needle) != -1:
+                    return None
+            return hashlib.sha1(mm).hexdigest()
+
+
+def enable_lines(fn, lines, hits):
+    """
+    Yield a tuple (line, new_line) for each line in lines, with lines toggled by loggle.py enabled.
+    hits[0] is incremented for each line containing SELF_KEY.
+    """
+    self_key = ENABLE_NEEDLES[0]
+    for line in lines:
+        if self_key in line:
+            hits[0] += 1
+            if TAG in line:
+                yield line, line.replace(TAG, b"", 1)
+                continue
+            print("failed while splitting line for SELF_KEY: " + SELF_KEY + " in file: " + fn)
+        yield line, line
 
 
 def enable_file(fn):
-    global HITS
-    data = read_file(fn)
-    new_data = []
-    for line in data:
-        if SELF_KEY in line:
-            HITS.add(fn)
-            try:
-                first, second = line.split(COMMENT_KEY + " " + SELF_KEY + " ", 1)
-                new_data.append(first + second)
-            except:
-                new_data.append(line)
-                print("failed while splitting line for SELF_KEY: " + SELF_KEY + " in file: " + fn)
-                pass
-        else:
-            new_data.append(line)
-    write_file(fn, new_data)
+    """
+    Enable the toggled lines in fn.
 
+    Return a tuple (hit, rewritten, digest):
+    hit is True if fn contained at least one line toggled by loggle.py.
+    rewritten is True if fn changed and was written back.
+    digest is the content digest of fn after toggling.
+    """
+    return toggle_file_lines(fn, ENABLE_NEEDLES, enable_lines)
 
-def enable(fns):
-    for f in fns:
-        enable_file(f)
+
+def toggle_file_lines(fn, needles, toggle_lines):
+    """
+    Run the lines of fn through the toggle_lines generator (enable_lines or disable_lines) and write fn back if it changed.
+    Files that don't contain any of needles are skipped (see prefilter_file).
+
+    Return a tuple (hit, rewritten, digest), see enable_file / disable_file.
+    """
+    digest = prefilter_file(fn, needles)
+    if digest is not None:
+        return False, False, digest
+    hits = [0]
+    with open(fn, "rb") as in_file:
+        rewritten, digest = update_file(fn, toggle_lines(fn, in_file, hits))
+    return hits[0] > 0 or rewritten, rewritten, digest
+
+
+def enable(fns, jobs=1, cache=None):
+    toggle(enable_file, "enabled", fns, jobs, cache)
+
+
+def disable_lines(fn, lines, hits):
+    """
+    Yield a tuple (line, new_line) for each line in lines, with lines beginning with a key in KEYS disabled.
+    hits[0] is incremented for each line beginning with a key.
+    """
+    for line in lines:
+        m = KEY_PATTERN.match(line)
+        if m:
+            hits[0] += 1
+            indent = m.end(1)
+            yield line, line[:indent] + TAG + line[indent:]
+        else:
+            yield line, line
 
 
 def disable_file(fn):
-    global HITS
-    data = read_file(fn)
-    new_data = []
-    for line in data:
-        strip_line = line.strip()
-        new_line = line
-        for k in KEYS:
-            if strip_line.startswith(k):
-                HITS.add(fn)
-                try:
-                    before, after = line.split(k, 1)
-                    new_line = before + COMMENT_KEY + " " + SELF_KEY + " " + k + after
-                except:
-                    new_line = line
-                    print("failed while splitting line for key: " + k + " in file: " + fn)
-                    pass
-                break
-        new_data.append(new_line)
-    write_file(fn, new_data)
+    """
+    Disable (comment out) the lines in fn beginning with a key in KEYS.
 
+    Return a tuple (hit, rewritten, digest):
+    hit is True if fn contained at least one line beginning with a key in KEYS.
+    rewritten is True if fn changed and was written back.
+    digest is the content digest of fn after toggling.
+    """
+    return toggle_file_lines(fn, DISABLE_NEEDLES, disable_lines)
+
+
+def disable(fns, jobs=1, cache=None):
+    toggle(disable_file, "disabled", fns, jobs, cache)
+
+
+def init_worker(keys, comment_key, self_key, check):
+    """
+    Copy the toggle settings into a worker process.
+    (workers don't inherit module globals on platforms that spawn instead of fork)
+    """
+    global KEYS, COMMENT_KEY, SELF_KEY, CHECK
+    KEYS = keys
+    COMMENT_KEY = comment_key
+    SELF_KEY = self_key
+    CHECK = check
+    compile_keys()
+
+
+def get_cache_signature():
+    """
+    Return a digest of the settings that determine what toggling a file does.
+    A cache written with different settings is invalid.
+    """
+    settings = [CACHE_VERSION, KEYS, SELF_KEY, COMMENT_KEY, ENCODING]
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
 
-def disable(fns):
-    for f in fns:
-        disable_file(f)
+
+def load_cache(fn):
+    """
+    Return the file entries of the state cache in fn.
+    {key->value}
+    {absolute filename->[size, mtime_ns, content digest, list of states the file is known to be in]}
+
+    Return an empty cache if fn doesn't exist, can't be parsed, or was written with different KEYS / SELF_KEY / COMMENT_KEY.
+    """
+    try:
+        with open(fn) as in_file:
+            data = json.load(in_file)
+        if data["signature"] == get_cache_signature():
+            return data["files"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+
+def save_cache(fn, cache):
+    """
+    Write the state cache to fn atomically.
+    """
+    dn = os.path.dirname(os.path.abspath(fn))
+    fd, tmp_fn = tempfile.mkstemp(prefix=".loggle-cache.", dir=dn)
+    try:
+        with open(fd, "w") as out_file:
+            json.dump({"signature": get_cache_signature(), "files": cache}, out_file)
+        os.replace(tmp_fn, fn)
+    except:
+        os.remove(tmp_fn)
+        raise
+
+
+def toggle_worker(job):
+    """
+    Run a toggle function on a single file.
+
+    job is (toggle_file, fn, digest).  If digest is given it is the digest fn had when it was last toggled,
+    and fn is only toggled if its content changed since.
+
+    Return the filename, the (hit, rewritten, digest) result of toggle_file (None if fn wasn't toggled), and the size and mtime_ns of fn afterwards.
+    """
+    toggle_file, fn, digest = job
+    result = None
+    if digest is None or file_digest(fn) != digest:
+        result = toggle_file(fn)
+    st = os.stat(fn)
+    return fn, result, st.st_size, st.st_mtime_ns
+
+
+def make_jobs(toggle_file, state, fns, cache):
+    """
+    Yield a toggle_worker job for each file in fns that may need toggling.
+
+    Files the cache shows are already in state, unchanged since they were toggled, are skipped without being opened.
+    Files whose mtime changed but size didn't are checked against their cached digest before toggling.
+    """
+    for fn in fns:
+        entry = cache.get(fn) if cache is not None else None
+        if entry is None or state not in entry[3]:
+            yield toggle_file, fn, None
+            continue
+        st = os.stat(fn)
+        if st.st_size != entry[0]:
+            yield toggle_file, fn, None
+        elif st.st_mtime_ns != entry[1]:
+            yield toggle_file, fn, entry[2]
+        else:
+            STATS["cached"] += 1
+
+
+def toggle(toggle_file, state, fns, jobs=1, cache=None):
+    """
+    Run toggle_file (enable_file or disable_file) on each file in fns, collect the files with hits in HITS and count reads / rewrites in STATS.
+    state is the state ("enabled" or "disabled") toggle_file leaves a file in.
+
+    If jobs > 1 the files are spread across a pool of jobs worker processes.
+    If a cache (see load_cache) is given, files already in state are skipped and the cache is updated with the files toggled.
+    (in check mode the cache is only used to skip files, it isn't updated)
+    """
+    compile_keys()
+    work = make_jobs(toggle_file, state, fns, cache)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(KEYS, COMMENT_KEY, SELF_KEY, CHECK)) as pool:
+            for result in pool.imap_unordered(toggle_worker, work, CHUNK_SIZE):
+                collect_result(state, cache, *result)
+    else:
+        for job in work:
+            collect_result(state, cache, *toggle_worker(job))
+
+
+def collect_result(state, cache, fn, result, size, mtime_ns):
+    global HITS
+    STATS["read"] += 1
+    if result is None:
+        # content unchanged since it was last toggled, only the mtime moved
+        if cache is not None and not CHECK:
+            cache[fn][0:2] = [size, mtime_ns]
+        return
+    hit, rewritten, digest = result
+    if rewritten:
+        STATS["rewritten"] += 1
+        CHANGED.add(fn)
+    if hit:
+        HITS.add(fn)
+    if cache is not None and not CHECK:
+        entry = cache.get(fn)
+        states = [state]
+        if entry is not None and entry[2] == digest:
+            # toggling didn't change the file, so it's still in any state it was in before
+            states = sorted(set(entry[3]) | {state})
+        cache[fn] = [size, mtime_ns, digest, states]
 
 
 def do_report(enabled):
@@ -145,9 +544,29 @@ def do_report(enabled):
         print("\nFound no instances of:\n")
         print(KEYS)
         print("\nin target files -- Nothing to do!\n")
+    print("read " + str(STATS["read"]) + " files, rewrote " + str(STATS["rewritten"]) + " files")
+    if STATS["cached"]:
+        print("skipped " + str(STATS["cached"]) + " files already " + ("enabled" if enabled else "disabled") + " (cached)")
+
+
+def do_check_report(enabled):
+    """
+    Report the files that would change in check mode.
+
+    Return the exit status: 1 if any file would change, otherwise 0.
+    """
+    if CHANGED:
+        print("\nthese files would be " + ("enabled" if enabled else "disabled") + ":\n")
+        for fn in sorted(CHANGED):
+            print(fn)
+        print()
+        return 1
+    print("\nno files would change -- Nothing to do!\n")
+    return 0
 
 
 def main(argv):
+    global CHECK
     make_file_types_lc() # make file types lowercase in case user added uppercase
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group(required=True)
@@ -155,18 +574,34 @@ def main(argv):
     group.add_argument("-d", "--disable", action="store_true", help="disable logging statements")
     parser.add_argument("-k", "--keys", help="specify a keys file containing strings that should be toggled in code")
     parser.add_argument("-t", "--targets", nargs="+", help="files / directories to act on", required=True)
-    args = parser.parse_args()
+    parser.add_argument("-x", "--exclude", nargs="+", default=[], help=".gitignore-style patterns of files / directories to skip (" + ", ".join(EXCLUDE_DIRS) + " are always skipped)")
+    parser.add_argument("--exclude-from", help="read exclude patterns from a file (e.g. a .gitignore)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes to toggle files with (default 1, 0 uses all cpus)")
+    parser.add_argument("--check", action="store_true", help="dry run: list the files that would change without writing anything (exits 1 if any would)")
+    parser.add_argument("-c", "--cache", nargs="?", const=CACHE_FILENAME, help="keep a state cache file (default " + CACHE_FILENAME + ") so repeat runs skip files already toggled")
+    args = parser.parse_args(argv)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    CHECK = args.check
 
     if args.keys:
         parse_keys(args.keys)
-    parse_targets(args.targets)
+    parse_excludes(args.exclude)
+    if args.exclude_from:
+        parse_exclude_file(args.exclude_from)
+    targets = iter_targets(args.targets) # targets stream to the toggle stage as they are found
 
+    cache = load_cache(args.cache) if args.cache else None
     if(args.enable):
-        enable(TARGETS)
+        enable(targets, jobs, cache)
     else:
-        disable(TARGETS)
+        disable(targets, jobs, cache)
+    if CHECK:
+        return do_check_report(args.enable)
+    if cache is not None:
+        save_cache(args.cache, cache)
     do_report(args.enable)
+    return 0
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
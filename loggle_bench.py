@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark loggle.py on a synthetic source tree.
+
+Generates a tree of .dart / .py / .cpp / .c files, then times target discovery (parse_targets), disable, a repeat disable
+(nothing left to do) and enable.  Each phase runs in its own process so its peak RSS can be measured.
+Results are appended to a JSON lines file, one record per run, so runs of different versions can be compared.
+"""
+
+import sys
+import os
+import argparse
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import multiprocessing
+from datetime import datetime, timezone
+
+import loggle
+
+FILLER_LINES = ["int x = 0;", "x += 1;", "if (x > 1) {", "}", "return x;", "var s = \"loggle bench\";", "foo(x, s);"]
+PHASES = [("parse_targets", None), ("disable", loggle.disable), ("disable_repeat", loggle.disable), ("enable", loggle.enable)]
+
+
+def parse_mix(mix):
+    """
+    Parse a file type mix like "dart=4,py=1,cpp=1,c=1" into a list of (extension, weight).
+    """
+    file_mix = []
+    for item in mix.split(","):
+        ext, weight = item.split("=")
+        file_mix.append(("." + ext.strip().lstrip("."), float(weight)))
+    return file_mix
+
+
+def make_keys(num_keys):
+    """
+    Return a key list of num_keys keys: the default loggle KEYS followed by synthetic logging calls.
+    """
+    keys = list(loggle.KEYS)
+    i = 0
+    while len(keys) < num_keys:
+        keys.append("trace" + str(i) + "(")
+        i += 1
+    return keys[:num_keys]
+
+
+def make_file_data(rng, size, hit_density, keys):
+    """
+    Return about size bytes of source, where a hit_density fraction of the lines begin with a key.
+    """
+    lines = []
+    length = 0
+    while length < size:
+        indent = "  " * rng.randint(0, 3)
+        if rng.random() < hit_density:
+            line = indent + rng.choice(keys) + "\"bench " + str(length) + "\");\n"
+        else:
+            line = indent + rng.choice(FILLER_LINES) + "\n"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines)
+
+
+def make_tree(root, args, keys):
+    """
+    Write a synthetic source tree of args.files files under root.
+
+    Files are spread over nested directories, args.dir_files files per directory.
+    Excluded directories (.dart_tool / build) are added too, so discovery has something to prune.
+
+    Return the total size in bytes of the target files.
+    """
+    rng = random.Random(args.seed)
+    file_mix = parse_mix(args.mix)
+    exts = [ext for ext, weight in file_mix]
+    weights = [weight for ext, weight in file_mix]
+    total = 0
+    for i in range(args.files):
+        dn = os.path.join(root, "lib", "d" + str(i // (args.dir_files * args.dir_files)), "d" + str(i // args.dir_files))
+        os.makedirs(dn, exist_ok=True)
+        ext = rng.choices(exts, weights)[0]
+        size = max(1, int(rng.uniform(0.5, 1.5) * args.size))
+        data = make_file_data(rng, size, args.hit_density, keys)
+        with open(os.path.join(dn, "f" + str(i) + ext), "w") as out_file:
+            out_file.write(data)
+        total += len(data.encode())
+    for excluded in (".dart_tool", "build"):
+        dn = os.path.join(root, excluded)
+        os.makedirs(dn, exist_ok=True)
+        for i in range(max(1, args.files // 10)):
+            with open(os.path.join(dn, "g" + str(i) + ".dart"), "w") as out_file:
+                out_file.write(make_file_data(rng, args.size, args.hit_density, keys))
+    return total
+
+
+def peak_rss_kb():
+    """
+    Return the peak RSS in KB of this process and its (waited for) children, e.g. pool workers.
+    """
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        rss //= 1024 # ru_maxrss is in bytes on macOS
+    return rss
+
+
+def run_phase(name, toggle, root, keys_fn, jobs, use_cache, queue):
+    """
+    Run a single benchmark phase (in a child process) and put its measurements on queue.
+    """
+    loggle.make_file_types_lc()
+    loggle.parse_keys(keys_fn)
+    cache_fn = os.path.join(root, loggle.CACHE_FILENAME)
+    start = time.perf_counter()
+    if toggle is None:
+        loggle.parse_targets([root])
+    else:
+        cache = loggle.load_cache(cache_fn) if use_cache else None
+        toggle(loggle.iter_targets([root]), jobs, cache)
+        if use_cache:
+            loggle.save_cache(cache_fn, cache)
+    seconds = time.perf_counter() - start
+    queue.put({
+        "phase": name,
+        "seconds": seconds,
+        "files": len(loggle.TARGETS) if toggle is None else loggle.STATS["read"],
+        "rewritten": loggle.STATS["rewritten"],
+        "hits": len(loggle.HITS),
+        "peak_rss_kb": peak_rss_kb(),
+    })
+
+
+def get_git_rev():
+    """
+    Return the git revision of the loggle.py being benchmarked, if it can be found.
+    """
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(loggle.__file__)), capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark loggle.py on a synthetic source tree.")
+    parser.add_argument("--files", type=int, default=2000, help="number of target files to generate (default 2000)")
+    parser.add_argument("--size", type=int, default=8192, help="average target file size in bytes (default 8192)")
+    parser.add_argument("--hit-density", type=float, default=0.02, help="fraction of lines that begin with a key (default 0.02)")
+    parser.add_argument("--keys", type=int, default=len(loggle.KEYS), help="number of keys in the keys file (default " + str(len(loggle.KEYS)) + ")")
+    parser.add_argument("--mix", default="dart=4,py=1,cpp=1,c=1", help="file type mix as ext=weight pairs (default dart=4,py=1,cpp=1,c=1)")
+    parser.add_argument("--dir-files", type=int, default=50, help="files per generated directory (default 50)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="loggle worker processes (default 1)")
+    parser.add_argument("-c", "--cache", action="store_true", help="run the toggle phases with a state cache (kept across phases)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to run the phases (default 1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the generated tree (default 0)")
+    parser.add_argument("--dir", help="generate the tree in this directory and keep it (default: a temp directory that is removed)")
+    parser.add_argument("-o", "--output", default="loggle_bench.jsonl", help="JSON lines file results are appended to (default loggle_bench.jsonl)")
+    args = parser.parse_args(argv)
+
+    root = args.dir or tempfile.mkdtemp(prefix="loggle_bench.")
+    keys = make_keys(args.keys)
+    try:
+        keys_fn = os.path.join(root, "keys.txt")
+        os.makedirs(root, exist_ok=True)
+        with open(keys_fn, "w") as out_file:
+            out_file.write("\n".join(keys) + "\n")
+        print("generating " + str(args.files) + " files in " + root + " ...")
+        total_bytes = make_tree(root, args, keys)
+
+        ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        runs = []
+        for r in range(args.repeat):
+            for name, toggle in PHASES:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=run_phase, args=(name, toggle, root, keys_fn, args.jobs, args.cache, queue))
+                proc.start()
+                result = queue.get()
+                proc.join()
+                result["run"] = r
+                result["files_per_sec"] = result["files"] / result["seconds"] if result["seconds"] else None
+                result["mb_per_sec"] = total_bytes / (1 << 20) / result["seconds"] if result["seconds"] else None
+                runs.append(result)
+                print("{phase:>16}: {seconds:8.3f} s  {files_per_sec:10.1f} files/s  {mb_per_sec:8.1f} MB/s  {peak_rss_kb:8d} KB peak rss".format(**result))
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "git_rev": get_git_rev(),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "params": {"files": args.files, "size": args.size, "hit_density": args.hit_density, "keys": args.keys, "mix": args.mix, "jobs": args.jobs, "cache": args.cache, "seed": args.seed},
+        "total_bytes": total_bytes,
+        "results": runs,
+    }
+    with open(args.output, "a") as out_file:
+        out_file.write(json.dumps(record) + "\n")
+    print("results appended to " + args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
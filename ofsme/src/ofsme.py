@@ -2,16 +2,55 @@
 
 """
 Obfuscate Me, a tool to obfuscate your text from stylometric analysis and author attribution tools
+
+It can be imported:
+    import ofsme
+    ofsme.obfuscate(text, seed=1)  # the obfuscated text
+    ofsme.uncommon_words(text)     # Counter of the words that aren't in the word frequency list
+the lookup tables are loaded the first time they're used, and kept.  (see ofsme_daemon.py to keep them loaded
+between runs)
 """
 
 import sys
+import os
+import argparse
+import configparser
+import contextlib
+import hashlib
+import math
+import pickle
 import random
+import re
+import tempfile
+import threading
+import time
+import multiprocessing
+from bisect import bisect_right
+from collections import Counter
+from fractions import Fraction
+from itertools import accumulate
+
+import phrases
+
+P_MUTATE = 3 / 700 # default probability a character is mutated by the key filter
+LOOKUP_CACHE_VERSION = 1 # bump when the tables built from the lookups change, so old cache files are rebuilt
+WORD_SEPARATORS = ",….:!;?\n" # words are split on these and spaces ("..." is split as ".")
+SEGMENT_RE = re.compile("([^ " + re.escape(WORD_SEPARATORS) + "]+)") # splits a line into segments (see split_segments)
+
+def open_text(filename, mode="r"):
+    """
+    Open a text file, "-" is stdin (or stdout if mode is "w").
+    """
+    if filename == "-":
+        return contextlib.nullcontext(sys.stdout if "w" in mode else sys.stdin)
+    return open(filename, mode)
+
 
 def get_text(text, input_filename):
     """
     Import the user text.
     """
-    with open(input_filename) as in_file:
+    with open_text(input_filename) as in_file:
         text.extend(in_file)
 
 
@@ -23,11 +62,14 @@ def get_wordlist(word_dict, wordlist_filename):
     Fills word_dict with word frequencies.
     {key->value}
     {word->frequency}
+
+    The lists are sorted most frequent first, so the frequency is the rank of the word (1 is the most common word).
     """
     with open(wordlist_filename) as in_file:
         freq = 1
         for word in in_file:
             word_dict[word.replace('\n', '')] = freq
+            freq += 1
 
 
 def get_key_map(key_dict, key_map_filename):
@@ -44,15 +86,103 @@ def get_key_map(key_dict, key_map_filename):
             key_dict[key] = [x for x in nearby.replace('\n', '')]
     
 
+def split_segments(line):
+    """
+    Split a line into a list of segments alternating the text between words (spaces and separators) and words:
+    [text, word, text, word, ..., text]
+    segments[1::2] are the words of the line (as they are in the line, with any backticks) and "".join(segments) is
+    the line.
+
+    This is the tokenizer for everything that needs words: the pipeline stages, the API and parse_words.
+    """
+    return SEGMENT_RE.split(line)
+
+
+def get_words(text):
+    """
+    Return the words in a string of text (see split_segments), with any backticks removed (a word of only backticks
+    isn't a word).
+    """
+    words = split_segments(text)[1::2]
+    if "`" in text:
+        words = [w for w in (w.replace("`", "") for w in words) if w]
+    return words
+
+
+def get_cache_dir():
+    """
+    Return the directory compiled lookups are cached in ($XDG_CACHE_HOME/ofsme, ~/.cache/ofsme by default).
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "ofsme")
+
+
+def file_digest(filename):
+    """
+    Return the hex digest of the content of filename.
+    """
+    h = hashlib.sha1()
+    with open(filename, "rb") as in_file:
+        for block in iter(lambda: in_file.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_lookup(lookup_filename, get_table, cache_dir=None):
+    """
+    Return the table get_table (e.g. get_wordlist, get_key_map) fills from lookup_filename, from the lookup cache if possible.
+
+    Tables are cached compiled (pickled) in cache_dir (get_cache_dir() by default), one file per lookup:
+    (version, size, mtime_ns, content digest, table)
+    The cached table is used if the size and mtime of lookup_filename match, or if its content digest does (e.g.
+    after a fresh checkout); otherwise the lookup is parsed again and the cache file rewritten.
+    Pass cache_dir="" to not use the cache.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    table = {}
+    if not cache_dir:
+        get_table(table, lookup_filename)
+        return table
+    path = os.path.abspath(lookup_filename)
+    st = os.stat(path)
+    key = hashlib.sha1((path + "\0" + get_table.__name__).encode()).hexdigest()[:16]
+    cache_filename = os.path.join(cache_dir, os.path.basename(path) + "." + key + ".pickle")
+    digest = None
+    try:
+        with open(cache_filename, "rb") as in_file:
+            version, size, mtime_ns, cached_digest, cached_table = pickle.load(in_file)
+        if version == LOOKUP_CACHE_VERSION:
+            if size == st.st_size and mtime_ns == st.st_mtime_ns:
+                return cached_table
+            digest = file_digest(path)
+            if digest == cached_digest:
+                table = cached_table
+    except Exception:
+        pass # no cache file yet, or it can't be read; (re)build it
+    if not table:
+        get_table(table, path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(prefix=".ofsme-cache.", dir=cache_dir)
+        try:
+            with open(fd, "wb") as out_file:
+                pickle.dump((LOOKUP_CACHE_VERSION, st.st_size, st.st_mtime_ns, digest or file_digest(path), table), out_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, cache_filename)
+        except:
+            os.remove(tmp_filename)
+            raise
+    except OSError:
+        pass # the cache is only an optimization
+    return table
+
+
 def parse_words(words, text):
     """
-    Parse text into words
+    Parse text into words (text is a list of lines; a line doesn't have to end with a newline, words never run on
+    from one line to the next)
     """
-    temp = []
-    for line in text:
-        temp_line = line.replace(',', ' ').replace('…', ' ').replace('...', ' ').replace('.', ' ').replace(':', ' ').replace('!', ' ').replace('`', '').replace(';', ' ').replace('?',' ').replace('\n', ' ')
-        temp = [w for w in temp_line.split(' ') if w != '']
-        words.extend(temp)
+    words.extend(get_words("\n".join(text)))
     
 
 def get_lowercase(words):
@@ -62,7 +192,78 @@ def get_lowercase(words):
     return [w.lower() for w in words]
 
 
-def apply_key_filter(text, key_filter):
+def get_mutation_gap(rng, p_mutate):
+    """
+    Return the number of characters to skip before the next mutated character.
+
+    Each character is mutated with probability p_mutate, so the gaps between mutations are geometrically distributed;
+    drawing the gap takes one random number per mutation instead of one per character.
+    """
+    if p_mutate >= 1:
+        return 0
+    if p_mutate <= 0:
+        return sys.maxsize
+    return int(math.log(1.0 - rng.random()) / math.log1p(-p_mutate))
+
+
+def key_filter_segments(segments, nearby_keys, rng, p_mutate, pos):
+    """
+    Mutate a line split into segments (see split_segments; or any list of strings) with the key filter, changing
+    segments in place.
+
+    nearby_keys maps keys to a tuple of nearby keys, pos is the position of the next mutated character in the line
+    (it can be past the end of the line, mutations carry on across lines).
+
+    Return a tuple (position of the next mutated character after the line, number of characters mutated).
+    """
+    length = sum(map(len, segments))
+    if pos >= length:
+        return pos - length, 0
+    # mutations are sparse: find the segment of each mutated character from the segment end offsets
+    # (a key is replaced with a single nearby key, so the offsets don't change)
+    ends = list(accumulate(map(len, segments)))
+    mutations = 0
+    i = -1 # segment being mutated, its pieces are joined once it's done (so a long segment is rebuilt only once)
+    while pos < length:
+        if i == -1 or pos >= ends[i]:
+            if i != -1 and pieces:
+                pieces.append(segment[start:])
+                segments[i] = "".join(pieces)
+            i = bisect_right(ends, pos)
+            segment = segments[i]
+            segment_start = ends[i - 1] if i else 0
+            pieces = []
+            start = 0
+        k = pos - segment_start
+        if segment[k] in nearby_keys:
+            pieces.append(segment[start:k])
+            pieces.append(rng.choice(nearby_keys[segment[k]]))
+            start = k + 1
+            mutations += 1
+        pos += 1 + get_mutation_gap(rng, p_mutate)
+    if pieces:
+        pieces.append(segment[start:])
+        segments[i] = "".join(pieces)
+    return pos - length, mutations
+
+
+def iter_key_filter(text, key_filter, p_mutate=P_MUTATE, seed=None):
+    """
+    Mutate text using key_filter, one line at a time (text can be any iterable of lines, e.g. an open file).
+    Yields the mutated lines.
+
+    See apply_key_filter.
+    """
+    rng = random.Random(seed)
+    nearby_keys = {k: tuple(v) for k, v in key_filter.items() if v}
+    pos = get_mutation_gap(rng, p_mutate) # position of the next mutated character (in the current line)
+    for line in text:
+        segments = [line]
+        pos, mutations = key_filter_segments(segments, nearby_keys, rng, p_mutate, pos)
+        yield segments[0]
+
+
+def apply_key_filter(text, key_filter, p_mutate=P_MUTATE, seed=None):
     """
     Mutate text using key_filter.
     
@@ -71,22 +272,12 @@ def apply_key_filter(text, key_filter):
     {key->value}
     {key->list of nearby keys}
 
+    Each character is mutated with probability p_mutate (if it's in key_filter) to a random nearby key.
+    seed seeds the random numbers, so the same text, p_mutate and seed give the same mutated text.
+
     Returns a list of mutated text.
     """
-    p_mutate = 3
-    m_text = []
-    for line in text:
-        m_line = ""
-        for abc in line:
-            next_char = abc
-            if random.randint(0,699) < p_mutate:
-                if abc in key_filter:
-                    nearby_keys = key_filter[abc]
-                    random.shuffle(nearby_keys)
-                    next_char = nearby_keys[0]
-            m_line += next_char
-        m_text.append(m_line)
-    return m_text
+    return list(iter_key_filter(text, key_filter, p_mutate, seed))
 
 
 def get_uncommon_words(word_dict, user_words, word_list):
@@ -107,51 +298,489 @@ def get_uncommon_words(word_dict, user_words, word_list):
                 word_dict[w] += 1
 
 
-ENGLISH_FREQUENCY_LIST_FILENAME = "../lookups/google-10000-english.txt"
-ENGLISH_FREQUENCY_LIST_USA_FILENAME = "../lookups/google-10000-english-usa.txt"
-ENGLISH_FREQUENCY_LIST_20K_FILENAME = "../lookups/20k.txt"
-NEIGHBOR_KEY_MAP_FILENAME = "../lookups/neighbor_keys_map.txt"
+LOOKUPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lookups")
+ENGLISH_FREQUENCY_LIST_FILENAME = os.path.join(LOOKUPS_DIR, "google-10000-english.txt")
+ENGLISH_FREQUENCY_LIST_USA_FILENAME = os.path.join(LOOKUPS_DIR, "google-10000-english-usa.txt")
+ENGLISH_FREQUENCY_LIST_20K_FILENAME = os.path.join(LOOKUPS_DIR, "20k.txt")
+NEIGHBOR_KEY_MAP_FILENAME = os.path.join(LOOKUPS_DIR, "neighbor_keys_map.txt")
+
+
+CONFIG_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "ofsme.cfg")
+DEFAULT_CONFIG = {
+    "pipeline": {"stages": "key_exchange"},
+    "key_exchange": {"p_low": "3/700", "p_high": "3/700"},
+    "abbreviations": {"type": "phrases", "lookup": "abbreviations.txt", "p_low": "0.3", "p_high": "0.7"},
+} # used for anything not set in the config file
+
+LOOKUP_TABLES = {
+    "wordlist": (ENGLISH_FREQUENCY_LIST_20K_FILENAME, get_wordlist),
+    "key_map": (NEIGHBOR_KEY_MAP_FILENAME, get_key_map),
+} # lookup tables stages can use, by name
+LOADED_TABLES = {} # lookup tables loaded so far (see get_table)
+LOOKUP_CACHE_DIR = None # cache_dir for load_lookup ("" with --no-cache)
+TABLES_LOCK = threading.Lock() # tables are loaded once, even if threads (e.g. ofsme_daemon) ask for them at once
+
+
+def get_table(name):
+    """
+    Return the lookup table name (see LOOKUP_TABLES), it's loaded the first time it's used.
+    """
+    if name not in LOADED_TABLES:
+        with TABLES_LOCK:
+            if name not in LOADED_TABLES:
+                lookup_filename, get_lookup_table = LOOKUP_TABLES[name]
+                LOADED_TABLES[name] = load_lookup(lookup_filename, get_lookup_table, LOOKUP_CACHE_DIR)
+    return LOADED_TABLES[name]
+
+
+def parse_probability(value):
+    """
+    Parse a probability from the config file, as a decimal (0.005) or a fraction (3/700).
+    """
+    return float(Fraction(value.strip()))
+
+
+def get_phrase_map(phrase_map, phrases_filename):
+    """
+    Import a phrase map (lines of "phrase<tab>replacement").
+
+    Fills phrase_map with the compiled automaton (see phrases.compile_phrases).
+    """
+    phrase_map.update(phrases.compile_phrases(phrases.read_phrases(phrases_filename), split_segments))
+
 
+STAGES = {} # pipeline stage classes, by name (see register_stage)
 
-USAGE_MESSAGE = "./ofsme.py input_file output_file"
 
-if len(sys.argv) != 3:
-    print(USAGE_MESSAGE)
-    sys.exit(1)
+def register_stage(cls):
+    """
+    Class decorator adding a Stage to the stages pipelines can be made of (under cls.name).
+    """
+    STAGES[cls.name] = cls
+    return cls
+
+
+class Stage:
+    """
+    A filter in a Pipeline, applied to the segments of each line in turn (see split_segments).
+
+    A stage is configured by the section of the config file with its name (the section's type option picks the stage
+    class, by default the class registered under that name).  Its probability p is drawn from the
+    range p_low to p_high of the section once per pipeline (i.e. per document), so the strength of the obfuscation
+    varies between documents.
+
+    Subclasses set name and implement apply(segments), which changes segments in place and adds the number of changes
+    it made (or, for stages that only look at the text, the number of things found) to count.
+    """
+    name = None
 
-input_filename = sys.argv[1]
-output_filename = sys.argv[2]
+    def __init__(self, section, rng):
+        self.rng = rng
+        p_low = parse_probability(section.get("p_low", "0"))
+        p_high = parse_probability(section.get("p_high", section.get("p_low", "0")))
+        self.p = p_low if p_low == p_high else rng.uniform(p_low, p_high)
+        self.count = 0
+        self.seconds = 0.0
+
+    def apply(self, segments):
+        raise NotImplementedError
+
+
+@register_stage
+class UncommonWordsStage(Stage):
+    """
+    Count the uncommon words (see get_uncommon_words) in uwords, without changing the text.
+    """
+    name = "uncommon_words"
+
+    def __init__(self, section, rng):
+        super().__init__(section, rng)
+        self.word_list = get_table("wordlist")
+        self.uwords = Counter()
+
+    def apply(self, segments):
+        word_list = self.word_list
+        uncommon = [w for w in segments[1::2] if w not in word_list]
+        if "`" in "".join(uncommon):
+            uncommon = [w.replace("`", "") for w in uncommon]
+            uncommon = [w for w in uncommon if w and w not in word_list]
+        self.uwords.update(uncommon)
+        self.count += len(uncommon)
+
+
+@register_stage
+class KeyExchangeStage(Stage):
+    """
+    The key exchange filter (see key_filter_segments), each character is mutated to a nearby key with probability p.
+    """
+    name = "key_exchange"
+
+    def __init__(self, section, rng):
+        super().__init__(section, rng)
+        self.nearby_keys = {k: tuple(v) for k, v in get_table("key_map").items() if v}
+        self.pos = get_mutation_gap(rng, self.p) # position of the next mutated character (in the current segment)
+
+    def apply(self, segments):
+        self.pos, mutations = key_filter_segments(segments, self.nearby_keys, self.rng, self.p, self.pos)
+        self.count += mutations
+
+
+@register_stage
+class PhraseStage(Stage):
+    """
+    Replace phrases with the phrase map in the file named by the lookup option (in the lookups directory),
+    each phrase found is replaced with probability p.
+
+    All of the phrases are found in a single pass over the words of a line (see phrases.PhraseMatcher).  There can
+    be any number of phrase stages (abbreviations, slang, ...), each a config section with type = phrases.
+    """
+    name = "phrases"
+
+    def __init__(self, section, rng):
+        super().__init__(section, rng)
+        lookup = section.get("lookup")
+        if not lookup:
+            raise ValueError("phrase stage without a lookup file in the config file")
+        table_name = "phrases:" + lookup
+        LOOKUP_TABLES.setdefault(table_name, (os.path.join(LOOKUPS_DIR, lookup), get_phrase_map))
+        self.matcher = phrases.PhraseMatcher(get_table(table_name))
+
+    def apply(self, segments):
+        replaced = self.matcher.replace(segments, self.rng, self.p)
+        if replaced:
+            # replacements can hold separators; split the line again so the segments alternate text and words
+            segments[:] = split_segments("".join(segments))
+            self.count += replaced
+
+
+class Pipeline:
+    """
+    A list of stages applied to a text in a single traversal: each line is split into segments once, and the
+    segments passed through every stage in turn.
+    """
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self, text):
+        """
+        Run the stages on text (any iterable of lines, e.g. an open file), yields the obfuscated lines.
+        """
+        stages = self.stages
+        perf_counter = time.perf_counter
+        for line in text:
+            segments = split_segments(line)
+            for stage in stages:
+                start = perf_counter()
+                stage.apply(segments)
+                stage.seconds += perf_counter() - start
+            yield "".join(segments)
+
+    def get_uwords(self):
+        """
+        Return the Counter of uncommon words in the text run so far.
+        """
+        return self.stages[0].uwords
+
+    def get_stats(self):
+        """
+        Return the time spent in and count of each stage.
+        {key->value}
+        {stage name->[seconds, count]}
+        """
+        return {stage.name: [stage.seconds, stage.count] for stage in self.stages}
+
+
+def read_config(config_filename=None):
+    """
+    Return the configuration, DEFAULT_CONFIG updated from config_filename (CONFIG_FILENAME if it exists by default).
+    {key->value}
+    {section->{option->value}}
+    """
+    parser = configparser.ConfigParser()
+    parser.read_dict(DEFAULT_CONFIG)
+    if config_filename is None:
+        parser.read(CONFIG_FILENAME)
+    else:
+        with open(config_filename) as in_file:
+            parser.read_file(in_file)
+    return {section: dict(parser[section]) for section in parser.sections()}
+
+
+def set_p_mutate(config, p_mutate):
+    """
+    Return a copy of config with the key filter probability set to p_mutate.
+    """
+    config = dict(config)
+    config["key_exchange"] = dict(config.get("key_exchange", {}), p_low=str(p_mutate), p_high=str(p_mutate))
+    return config
+
+
+DEFAULT_CONFIG_CACHE = [] # the config read from CONFIG_FILENAME (see get_config)
+
+
+def get_config():
+    """
+    Return the configuration from the default config file (see read_config), it's read the first time it's used.
+    """
+    if not DEFAULT_CONFIG_CACHE:
+        DEFAULT_CONFIG_CACHE.append(read_config())
+    return DEFAULT_CONFIG_CACHE[0]
+
+
+def make_pipeline(config, seed=None):
+    """
+    Return a Pipeline of the stages listed in the pipeline section of config.
+    (the uncommon_words stage always comes first, so it sees the words before any filter changes them)
+
+    Each stage has its own random numbers, seeded with seed and the stage name, so a stage's output doesn't depend on
+    which other stages run.
+    """
+    names = [name.strip() for name in config["pipeline"]["stages"].split(",") if name.strip()]
+    names = [UncommonWordsStage.name] + [name for name in names if name != UncommonWordsStage.name]
+    stages = []
+    for name in names:
+        section = config.get(name, {})
+        stage_type = section.get("type", name)
+        if stage_type not in STAGES:
+            raise ValueError("unknown stage in the config file: " + stage_type)
+        rng = random.Random(None if seed is None else str(seed) + ":" + name)
+        stage = STAGES[stage_type](section, rng)
+        stage.name = name
+        stages.append(stage)
+    return Pipeline(stages)
+
+
+def get_api_config(config=None, p_mutate=None):
+    """
+    Return config (get_config() by default), with the key filter probability set to p_mutate if it's given.
+    """
+    config = config if config is not None else get_config()
+    return config if p_mutate is None else set_p_mutate(config, p_mutate)
+
+
+def obfuscate(text, seed=None, p_mutate=None, config=None):
+    """
+    Return text (a string) obfuscated with the stages of config (get_config() by default).
+    seed and p_mutate are as --seed and --p-mutate.
+    """
+    pipeline = make_pipeline(get_api_config(config, p_mutate), seed)
+    return "".join(pipeline.run(text.splitlines(True)))
+
+
+def uncommon_words(text):
+    """
+    Return a Counter of the uncommon words (see get_uncommon_words) in text (a string).
+    """
+    uwords = Counter()
+    get_uncommon_words(uwords, get_words(text), get_table("wordlist"))
+    return uwords
+
+
+def stream_text(in_file, out_file, pipeline):
+    """
+    Obfuscate in_file to out_file with pipeline a line at a time, so memory stays bounded however long the text is.
+    """
+    out_file.writelines(pipeline.run(in_file))
+
+
+def print_stage_stats(stats, out_file):
+    print("stage               time     count", file=out_file)
+    for name, (seconds, count) in stats.items():
+        print("{0:<16} {1:8.3f} s {2:9d}".format(name, seconds, count), file=out_file)
+
+
+def print_uncommon_words(uwords, out_file):
+    print("these words are uncommon:", file=out_file)
+    for w in uwords:
+        print(w + "\t\t" + str(uwords[w]), file=out_file)
+
+
+def init_worker(cache_dir):
+    """
+    Initialize a batch worker process.
+    Forked workers already have the lookup tables loaded by run_batch (shared copy on write); spawned workers load
+    them from the lookup cache as they're used.
+    """
+    global LOOKUP_CACHE_DIR
+    LOOKUP_CACHE_DIR = cache_dir
+
+
+def find_documents(paths, out_dir):
+    """
+    Return a list of (input filename, output filename) for the documents in paths.
+
+    Directories in paths are searched recursively (hidden files and directories, and out_dir, are skipped); their
+    documents are written to the same relative path under out_dir.  Other paths are written to out_dir by name.
+    Raise a ValueError if two documents would be written to the same output filename, or a document would be
+    written over a document (e.g. out_dir is a directory in paths).
+    """
+    real_out_dir = os.path.realpath(out_dir)
+    documents = []
+    for path in paths:
+        if os.path.isdir(path):
+            if os.path.realpath(path) == real_out_dir:
+                raise ValueError("the output directory {0} is one of the directories of documents".format(out_dir))
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith(".") and os.path.realpath(os.path.join(root, d)) != real_out_dir)
+                for f in sorted(files):
+                    if not f.startswith("."):
+                        in_filename = os.path.join(root, f)
+                        documents.append((in_filename, os.path.join(out_dir, os.path.relpath(in_filename, path))))
+        else:
+            documents.append((path, os.path.join(out_dir, os.path.basename(path))))
+    in_filenames = {os.path.realpath(in_filename): in_filename for in_filename, out_filename in documents}
+    out_filenames = {}
+    for in_filename, out_filename in documents:
+        real_out_filename = os.path.realpath(out_filename)
+        if real_out_filename in in_filenames:
+            raise ValueError("{0} would be written over {1}".format(in_filename, in_filenames[real_out_filename]))
+        if real_out_filename in out_filenames:
+            raise ValueError("{0} and {1} would both be written to {2}".format(out_filenames[real_out_filename], in_filename, out_filename))
+        out_filenames[real_out_filename] = in_filename
+    return documents
+
+
+def get_document_seed(seed, name):
+    """
+    Return the seed for the document name (its path relative to the output directory) in a batch,
+    derived from the batch seed (None if seed is None).
+    The same document gets the same seed whichever other documents are in the batch, or which worker runs it.
+    """
+    if seed is None:
+        return None
+    return str(seed) + ":" + name
+
+
+def obfuscate_document(job):
+    """
+    Obfuscate a single document of a batch, job is a tuple (input filename, output filename, config, document seed).
+
+    Return a tuple (input filename, bytes processed, Counter of uncommon words, stage stats, error message).
+    Any error is caught and returned as the error message (None if the document was obfuscated), so one bad
+    document doesn't stop a batch.
+    """
+    in_filename, out_filename, config, seed = job
+    written = False
+    try:
+        pipeline = make_pipeline(config, seed)
+        os.makedirs(os.path.dirname(out_filename) or ".", exist_ok=True)
+        with open(in_filename) as in_file, open(out_filename, "w") as out_file:
+            written = True
+            stream_text(in_file, out_file, pipeline)
+        return in_filename, os.path.getsize(in_filename), pipeline.get_uwords(), pipeline.get_stats(), None
+    except Exception as e:
+        if written:
+            os.remove(out_filename) # don't leave a partial output behind
+        return in_filename, 0, Counter(), {}, "{0}: {1}".format(type(e).__name__, e)
+
+
+def run_batch(paths, out_dir, config, jobs=1, seed=None):
+    """
+    Obfuscate the documents in paths (see find_documents) to out_dir, in jobs worker processes.
+
+    Return a tuple (list of obfuscate_document results, corpus Counter of uncommon words, total stage stats).
+    """
+    # make a pipeline before starting the workers: it checks the config and loads the lookup tables the stages use,
+    # so forked workers share them (copy on write) instead of each loading their own
+    make_pipeline(config)
+    jobs_list = [(in_filename, out_filename, config, get_document_seed(seed, os.path.relpath(out_filename, out_dir)))
+                 for in_filename, out_filename in find_documents(paths, out_dir)]
+    if jobs > 1 and len(jobs_list) > 1:
+        ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        with ctx.Pool(min(jobs, len(jobs_list)), initializer=init_worker, initargs=(LOOKUP_CACHE_DIR,)) as pool:
+            results = list(pool.imap_unordered(obfuscate_document, jobs_list))
+    else:
+        results = [obfuscate_document(job) for job in jobs_list]
+    corpus_uwords = Counter()
+    corpus_stats = {}
+    for in_filename, size, uwords, stats, error in results:
+        corpus_uwords.update(uwords)
+        for name, (seconds, count) in stats.items():
+            total = corpus_stats.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += count
+    return results, corpus_uwords, corpus_stats
+
+
+def do_batch_report(results, corpus_uwords, seconds, out_file):
+    """
+    Print the corpus uncommon words (most common first) and a summary of a batch run, with any failures.
+    """
+    print_uncommon_words(dict(corpus_uwords.most_common()), out_file)
+    failures = [(fname, error) for fname, size, uwords, stats, error in results if error]
+    done = len(results) - len(failures)
+    total_bytes = sum(size for fname, size, uwords, stats, error in results)
+    rate = (done / seconds) if seconds > 0 else 0
+    print("\nobfuscated {0} of {1} documents ({2:.1f} MB) in {3:.2f} s ({4:.1f} documents/s)".format(done, len(results), total_bytes / (1 << 20), seconds, rate), file=out_file)
+    if failures:
+        print("\n{0} failed:".format(len(failures)), file=out_file)
+        for fname, error in sorted(failures):
+            print(fname + ": " + error, file=out_file)
 
-# import text to analyze and obfuscate
-user_text = []
-get_text(user_text, input_filename)
 
-# import word frequency list
-word_freq_list = {}
-get_wordlist(word_freq_list, ENGLISH_FREQUENCY_LIST_20K_FILENAME)
+def main(argv):
+    global LOOKUP_CACHE_DIR
+    parser = argparse.ArgumentParser(description="Obfuscate text from stylometric analysis and author attribution tools.")
+    parser.add_argument("files", nargs="+", metavar="input_file output_file", help="text to analyze and obfuscate and the file to write the obfuscated text to (- for stdin / stdout), or with --out-dir, any number of documents and directories of documents")
+    parser.add_argument("--out-dir", help="batch mode: obfuscate each document to the same (relative) name in this directory, and report the uncommon words of the whole corpus")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes in batch mode (default 1, 0 uses all cpus)")
+    parser.add_argument("--stream", action="store_true", help="process the input a line at a time, writing output as it goes (uncommon words are reported to stderr at the end)")
+    parser.add_argument("--config", help="config file setting the filter stages and their probabilities (default ofsme/ofsme.cfg)")
+    parser.add_argument("--seed", type=int, help="random seed (the same seed gives the same output)")
+    parser.add_argument("--p-mutate", type=float, help="probability a character is mutated by the key filter (overrides the config file)")
+    parser.add_argument("--stats", action="store_true", help="report the time spent in and count of each stage")
+    parser.add_argument("--no-cache", action="store_true", help="parse the lookups without using (or writing) the lookup cache")
+    args = parser.parse_args(argv[1:])
+    if args.no_cache:
+        LOOKUP_CACHE_DIR = ""
+    try:
+        config = read_config(args.config)
+    except (OSError, configparser.Error) as e:
+        parser.error("can't read the config file: " + str(e))
+    if args.p_mutate is not None:
+        config = set_p_mutate(config, args.p_mutate)
 
-# import neighbor key map
-key_map = {}
-get_key_map(key_map, NEIGHBOR_KEY_MAP_FILENAME)
+    if args.out_dir:
+        start = time.perf_counter()
+        try:
+            results, corpus_uwords, corpus_stats = run_batch(args.files, args.out_dir, config, args.jobs if args.jobs > 0 else os.cpu_count(), args.seed)
+        except ValueError as e:
+            parser.error(str(e))
+        do_batch_report(results, corpus_uwords, time.perf_counter() - start, sys.stdout)
+        if args.stats:
+            print_stage_stats(corpus_stats, sys.stdout)
+        return 1 if any(error for fname, size, uwords, stats, error in results) else 0
+    if len(args.files) != 2:
+        parser.error("expected input_file output_file (or use --out-dir)")
+    args.input_file, args.output_file = args.files
 
-# parse words from text
-user_words = []
-parse_words(user_words, user_text)
+    # the obfuscated text may go to stdout, report to stderr then
+    report_file = sys.stderr if args.stream or args.output_file == "-" else sys.stdout
 
+    try:
+        pipeline = make_pipeline(config, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
 
-# find uncommon words in user text
-uwords = {}
-get_uncommon_words(uwords, user_words, word_freq_list)
+    if args.stream:
+        with open_text(args.input_file) as in_file, open_text(args.output_file, "w") as out_file:
+            stream_text(in_file, out_file, pipeline)
+        print_uncommon_words(pipeline.get_uwords(), report_file)
+    else:
+        # import text to analyze and obfuscate
+        user_text = []
+        get_text(user_text, args.input_file)
 
-print("these words are uncommon:")
-for w in uwords:
-    print(w + "\t\t" + str(uwords[w]))
+        # find uncommon words and apply the filters
+        m_text = list(pipeline.run(user_text))
+        print_uncommon_words(pipeline.get_uwords(), report_file)
+        with open_text(args.output_file, "w") as out_file:
+            out_file.writelines(m_text)
 
+    if args.stats:
+        print_stage_stats(pipeline.get_stats(), report_file)
+    return 0
 
-# apply key exchange filter
-print("\n\ntext with key exchange:\n")
-m_text = apply_key_filter(user_text, key_map)
-for line in m_text:
-    print(line, end="")
 
-# print(user_text)
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
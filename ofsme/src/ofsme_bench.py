@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+
+"""
+Micro-benchmark the ofsme.py tokenizer (split_segments) against the original chained str.replace parse_words.
+
+The input (a text file, repeated to make a larger corpus) is tokenized by each implementation and the best of
+--repeat runs is reported.  The word lists are checked to be identical first.
+"""
+
+import sys
+import os
+import argparse
+import textwrap
+import time
+
+import ofsme
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "test_files", "test_input2.txt")
+
+
+def legacy_parse_words(words, text):
+    """
+    The original parse_words, for comparison.
+    """
+    temp = []
+    for line in text:
+        temp_line = line.replace(',', ' ').replace('…', ' ').replace('...', ' ').replace('.', ' ').replace(':', ' ').replace('!', ' ').replace('`', '').replace(';', ' ').replace('?',' ').replace('\n', ' ')
+        temp = [w for w in temp_line.split(' ') if w != '']
+        words.extend(temp)
+
+
+def legacy_parse_tokens(tokens, text):
+    """
+    The original parse_words, followed by the search for each word in its line a filter needs to rewrite it in place
+    (what split_segments gives the pipeline stages).
+    (words with backticks removed can't be found; they're skipped)
+    """
+    for line in text:
+        words = []
+        legacy_parse_words(words, [line])
+        pos = 0
+        for w in words:
+            start = line.find(w, pos)
+            if start != -1:
+                tokens.append((w, start, start + len(w)))
+                pos = start + len(w)
+
+
+def parse_segments(segments, text):
+    for line in text:
+        segments.append(ofsme.split_segments(line))
+
+
+CASES = [
+    ("legacy parse_words", legacy_parse_words),
+    ("parse_words", ofsme.parse_words),
+    ("legacy words + offsets", legacy_parse_tokens),
+    ("split_segments", parse_segments),
+]
+
+
+def best_time(func, text, repeat):
+    """
+    Return the best time of repeat runs of func(result list, text), and the result of the last run.
+    """
+    best = None
+    for r in range(repeat):
+        result = []
+        start = time.perf_counter()
+        func(result, text)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Micro-benchmark the ofsme.py tokenizer.")
+    parser.add_argument("input_file", nargs="?", default=DEFAULT_INPUT, help="text to tokenize (default test_files/test_input2.txt)")
+    parser.add_argument("--copies", type=int, default=2000, help="number of copies of the input in the corpus (default 2000)")
+    parser.add_argument("--width", type=int, default=70, help="wrap the input to lines this wide, 0 keeps the input lines (default 70)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs of each case, the best is reported (default 5)")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.input_file) as in_file:
+        data = in_file.read()
+    if args.width:
+        lines = [line + "\n" for line in textwrap.wrap(data, args.width)]
+    else:
+        lines = data.splitlines(True)
+    text = lines * args.copies
+    size = sum(len(line) for line in text)
+
+    # (also without the newlines, e.g. lines from str.splitlines())
+    for check_text in ([line.rstrip("\n") for line in lines], text):
+        legacy_words = []
+        legacy_parse_words(legacy_words, check_text)
+        words = []
+        ofsme.parse_words(words, check_text)
+        if words != legacy_words:
+            print("parse_words doesn't match the legacy parse_words!")
+            return 1
+
+    print("{0} lines, {1:.1f} M characters, {2} words".format(len(text), size / 1e6, len(words)))
+    base = None
+    for name, func in CASES:
+        seconds, result = best_time(func, text, args.repeat)
+        base = base or seconds
+        print("{0:>24}: {1:8.4f} s  {2:8.1f} M chars/s  {3:5.2f}x legacy".format(name, seconds, size / seconds / 1e6, base / seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
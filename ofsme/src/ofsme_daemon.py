@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+
+"""
+A local ofsme daemon: keeps the lookup tables loaded and serves obfuscate / uncommon_words requests on a Unix socket,
+so a request doesn't pay for starting python and loading the tables (e.g. from an editor plugin).
+
+Requests and responses are JSON objects, one per line; a connection can send any number of requests.
+    {"op": "obfuscate", "text": "...", "seed": 1, "p_mutate": 0.01}
+        -> {"text": "...", "uncommon_words": {"word": count, ...}}
+    {"op": "uncommon_words", "text": "..."}
+        -> {"uncommon_words": {"word": count, ...}}
+seed and p_mutate are optional.  A request that fails gets {"error": "..."}.
+
+    ./ofsme_daemon.py serve [--socket PATH]
+    ./ofsme_daemon.py client [--socket PATH] [--seed N] [--p-mutate P] < input > output
+"""
+
+import sys
+import os
+import argparse
+import json
+import signal
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+
+import ofsme
+
+
+def get_private_dir():
+    """
+    Return the directory the default socket is in when $XDG_RUNTIME_DIR isn't set, a directory in the shared temp
+    directory made private to the user (see check_private_dir).
+    """
+    return os.path.join(tempfile.gettempdir(), "ofsme-" + str(os.getuid()))
+
+
+def get_default_socket():
+    """
+    Return the default socket path, in $XDG_RUNTIME_DIR (private to the user) if it's set, or else in get_private_dir().
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "ofsme.sock")
+    return os.path.join(get_private_dir(), "ofsme.sock")
+
+
+def check_private_dir(dn, create=False):
+    """
+    Raise an OSError unless dn is a directory (not a symlink) owned by the user that only the user can access.
+    If create, make dn (mode 0700) if it doesn't exist.
+    """
+    if create:
+        try:
+            os.mkdir(dn, 0o700)
+        except FileExistsError:
+            pass
+    st = os.lstat(dn)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(dn + " isn't a directory private to this user")
+
+
+def check_socket(socket_path):
+    """
+    Raise an OSError unless socket_path is a socket of a daemon run by the user, so text isn't sent to anyone else.
+    """
+    if os.path.dirname(socket_path) == get_private_dir():
+        check_private_dir(get_private_dir())
+    st = os.stat(socket_path)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(socket_path + " isn't a socket owned by this user")
+
+
+def handle_request(request):
+    """
+    Return the response to a request (see the module docstring).
+    """
+    op = request.get("op")
+    text = request.get("text")
+    if not isinstance(text, str):
+        raise ValueError("request without text")
+    if op == "obfuscate":
+        pipeline = ofsme.make_pipeline(ofsme.get_api_config(p_mutate=request.get("p_mutate")), request.get("seed"))
+        m_text = "".join(pipeline.run(text.splitlines(True)))
+        return {"text": m_text, "uncommon_words": dict(pipeline.get_uwords())}
+    if op == "uncommon_words":
+        return {"uncommon_words": dict(ofsme.uncommon_words(text))}
+    raise ValueError("unknown op: " + str(op))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answer the JSON line requests of a connection until it's closed.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = handle_request(json.loads(line))
+            except Exception as e:
+                response = {"error": "{0}: {1}".format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True # don't wait for open connections on shutdown
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove socket_path if it's left over from a daemon that's gone.
+    Raise an OSError if a daemon is listening on it, or it isn't a socket owned by the user (it's never removed then).
+    """
+    try:
+        st = os.lstat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(socket_path + " exists and isn't a socket owned by this user")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+            return
+    raise OSError("a daemon is already listening on " + socket_path)
+
+
+def serve(socket_path):
+    """
+    Serve requests on socket_path until SIGINT / SIGTERM.
+    """
+    # load the tables of the configured stages now, not on the first request
+    ofsme.make_pipeline(ofsme.get_config())
+    ofsme.get_table("wordlist")
+    if os.path.dirname(socket_path) == get_private_dir():
+        check_private_dir(get_private_dir(), create=True)
+    remove_stale_socket(socket_path)
+    old_umask = os.umask(0o077) # only the user can connect
+    try:
+        server = Server(socket_path, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print("ofsme daemon listening on " + socket_path, file=sys.stderr)
+    try:
+        with server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(socket_path)
+
+
+def request(socket_path, req):
+    """
+    Send a single request to the daemon on socket_path and return its response.
+    Raise an OSError if socket_path isn't the user's own daemon (see check_socket).
+    """
+    check_socket(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as sock_file:
+            sock_file.write(json.dumps(req).encode() + b"\n")
+            sock_file.flush()
+            return json.loads(sock_file.readline())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local ofsme daemon, keeps the lookup tables loaded between requests.")
+    parser.add_argument("command", choices=["serve", "client"], help="serve: run the daemon, client: obfuscate stdin to stdout with the daemon")
+    parser.add_argument("--socket", default=get_default_socket(), help="socket path (default " + get_default_socket() + ")")
+    parser.add_argument("--seed", type=int, help="random seed (client)")
+    parser.add_argument("--p-mutate", type=float, help="probability a character is mutated by the key filter (client)")
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "serve":
+        try:
+            serve(args.socket)
+        except OSError as e:
+            print("ofsme daemon: " + str(e), file=sys.stderr)
+            return 1
+        return 0
+
+    req = {"op": "obfuscate", "text": sys.stdin.read()}
+    if args.seed is not None:
+        req["seed"] = args.seed
+    if args.p_mutate is not None:
+        req["p_mutate"] = args.p_mutate
+    try:
+        response = request(args.socket, req)
+    except OSError as e:
+        print("can't connect to the ofsme daemon on " + args.socket + ": " + str(e), file=sys.stderr)
+        return 1
+    if "error" in response:
+        print(response["error"], file=sys.stderr)
+        return 1
+    sys.stdout.write(response["text"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,156 @@
+"""
+Multi-phrase replacement for ofsme lookup maps (abbreviations, jargon, slang, misspellings, ...).
+
+A phrase map is compiled once into an Aho-Corasick automaton over words, so all of the phrases in a map are found in
+a single pass over the words of a line, however many phrases there are.  Matching is case insensitive and only
+whole words match.  Where matches overlap, the leftmost (then the longest) is used.
+
+Phrase map files have a phrase and its replacement on each line, separated by a tab.
+Blank lines and lines beginning with # are skipped.
+"""
+
+SEPARATOR = "\0" # joins words to lowercase them in one call, can't be in a word
+
+
+def normalize_separator(text):
+    """
+    Return the text between two words with runs of whitespace made a single space, for comparing separators.
+    """
+    return " ".join(text.split()) if text.strip() else " "
+
+
+def read_phrases(phrases_filename):
+    """
+    Return a list of (phrase, replacement) from a phrase map file.
+    """
+    phrases = []
+    with open(phrases_filename) as in_file:
+        for line in in_file:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            phrase, replacement = line.split("\t", 1)
+            phrases.append((phrase.strip(), replacement.strip()))
+    return phrases
+
+
+def compile_phrases(phrases, split_segments):
+    """
+    Compile a list of (phrase, replacement) into an automaton for PhraseMatcher.
+
+    split_segments splits a phrase into [text, word, text, word, ..., text] (the same way the text to match is split).
+    The automaton is made of plain lists and dicts, so it can be cached (pickled).
+    {key->value}
+    {"goto"->list of {word->next state} for each state,
+     "fail"->list of the state to fall back to for each state,
+     "out"->list of the index in patterns of the phrase ending in each state (-1 if none),
+     "link"->list of the next state with a phrase ending in it along the fail links (0 if none),
+     "patterns"->list of (number of words, separators between the words, replacement)}
+    """
+    goto = [{}]
+    out = [-1]
+    patterns = []
+    for phrase, replacement in phrases:
+        segments = split_segments(phrase)
+        words = SEPARATOR.join(segments[1::2]).lower().replace("`", "").split(SEPARATOR)
+        if not phrase or not words[0]:
+            continue
+        state = 0
+        for word in words:
+            if word not in goto[state]:
+                goto[state][word] = len(goto)
+                goto.append({})
+                out.append(-1)
+            state = goto[state][word]
+        if out[state] == -1: # the first replacement for a phrase is used
+            out[state] = len(patterns)
+            patterns.append((len(words), [normalize_separator(sep) for sep in segments[2:-1:2]], replacement))
+
+    # breadth first, the fail state of each state is the longest proper suffix of its words that is also a state
+    fail = [0] * len(goto)
+    link = [0] * len(goto)
+    queue = list(goto[0].values())
+    for state in queue:
+        for word, next_state in goto[state].items():
+            f = fail[state]
+            while f and word not in goto[f]:
+                f = fail[f]
+            fail[next_state] = goto[f].get(word, 0)
+            link[next_state] = fail[next_state] if out[fail[next_state]] != -1 else link[fail[next_state]]
+            queue.append(next_state)
+    return {"goto": goto, "fail": fail, "out": out, "link": link, "patterns": patterns}
+
+
+class PhraseMatcher:
+    """
+    Find and replace the phrases of a compiled phrase map (see compile_phrases) in lines split into segments
+    [text, word, text, word, ..., text] (see ofsme.split_segments).
+    """
+    def __init__(self, automaton):
+        self.goto = automaton["goto"]
+        self.fail = automaton["fail"]
+        self.out = automaton["out"]
+        self.link = automaton["link"]
+        self.patterns = automaton["patterns"]
+
+    def find(self, segments):
+        """
+        Return a list of (first word, last word + 1, replacement) of the phrases in segments, in order.
+        Words are counted in segments[1::2]; matches don't overlap, the leftmost (then longest) match is used.
+        """
+        words = segments[1::2]
+        if not words:
+            return []
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        link = self.link
+        root = goto[0]
+        words = SEPARATOR.join(words).lower().replace("`", "").split(SEPARATOR)
+        matches = []
+        state = 0
+        for i, word in enumerate(words):
+            if not state and word not in root:
+                continue
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            # every phrase ending at this word, along the output links
+            s = state if out[state] != -1 else link[state]
+            while s:
+                n_words, separators, replacement = self.patterns[out[s]]
+                start = i + 1 - n_words
+                if all(normalize_separator(segments[2 * (start + k) + 2]) == sep for k, sep in enumerate(separators)):
+                    matches.append((start, i + 1, replacement))
+                s = link[s]
+        if len(matches) > 1:
+            # leftmost longest, non overlapping
+            matches.sort(key=lambda m: (m[0], -m[1]))
+            chosen = []
+            end = 0
+            for m in matches:
+                if m[0] >= end:
+                    chosen.append(m)
+                    end = m[1]
+            matches = chosen
+        return matches
+
+    def replace(self, segments, rng=None, p=1.0):
+        """
+        Replace the phrases in segments, changing segments in place.
+        Each phrase found is replaced with probability p (using rng, e.g. a random.Random).
+        The replacement keeps the capitalization of the first letter of the phrase.
+
+        Return the number of phrases replaced.
+        """
+        matches = self.find(segments)
+        replaced = 0
+        for start, end, replacement in reversed(matches): # from the end, so the segment indices stay valid
+            if p < 1 and rng.random() >= p:
+                continue
+            first = segments[2 * start + 1]
+            if first[:1].isupper() and replacement:
+                replacement = replacement[0].upper() + replacement[1:]
+            segments[2 * start + 1:2 * end] = [replacement]
+            replaced += 1
+        return replaced
@@ -3,10 +3,147 @@
 import sys
 import os
 import random
-import piexif
 import argparse
-from shutil import copyfile
+import errno
 import binascii
+import time
+import mmap
+import multiprocessing
+
+
+SHIFT_CHUNK_SIZE = 1 << 20 # size in bytes of the chunks the tail of a file is shifted in when inserting in place
+COPY_CHUNK_SIZE = 1 << 30 # max bytes per copy_file_range / sendfile call when writing a copy
+FILETYPES = ("png", "jpg", "jpeg", "gif", "webm", "mkv", "mp4", "m4v", "mov") # extensions of supported files (used to find files in directories)
+HEADER_SIZE = 32 # bytes read from the beginning of each file to detect its format
+REHASH_PREFIX = "rehash_" # prefix of the filename rehash writes to if NOT overwriting
+
+
+class RehashError(Exception):
+    """
+    Raised when a file can't be rehashed.  The message says why.
+    """
+
+
+def insert_bytes(in_file, offset, data):
+    """
+    Insert data at offset in in_file (opened "r+b").
+
+    The tail of the file (everything after offset) is shifted back by len(data) in fixed size chunks,
+    working backward from the end of the file so no chunk overwrites data that hasn't been moved yet.
+    Memory use is constant (one chunk) regardless of the file size.
+    """
+    if not data:
+        return
+    in_file.seek(0, os.SEEK_END)
+    pos = in_file.tell()
+    buf = bytearray(min(SHIFT_CHUNK_SIZE, max(pos - offset, 0)))
+    view = memoryview(buf)
+    while pos > offset:
+        size = min(len(buf), pos - offset)
+        pos -= size
+        in_file.seek(pos)
+        in_file.readinto(view[:size])
+        in_file.seek(pos + len(data))
+        in_file.write(view[:size])
+    in_file.seek(offset)
+    in_file.write(data)
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """
+    Copy count bytes from offset in src_fd to the current position of dst_fd.
+
+    Uses os.copy_file_range (the kernel copies the data, or shares the blocks on filesystems that support it),
+    then os.sendfile, then a plain buffered copy, whichever is available first.
+    """
+    ZERO_COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+    end = offset + count
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                n = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, end - offset), offset)
+                if n == 0:
+                    return
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in ZERO_COPY_FALLBACK_ERRORS:
+                raise
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                n = os.sendfile(dst_fd, src_fd, offset, min(COPY_CHUNK_SIZE, end - offset))
+                if n == 0:
+                    return
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in ZERO_COPY_FALLBACK_ERRORS:
+                raise
+    while offset < end:
+        data = os.pread(src_fd, min(SHIFT_CHUNK_SIZE, end - offset), offset)
+        if not data:
+            return
+        os.write(dst_fd, data)
+        offset += len(data)
+
+
+def write_with_insert(in_file, out_filename, offset, data):
+    """
+    Write a copy of in_file to out_filename with data inserted at offset, in a single pass:
+    the bytes before offset, then data, then the rest of the file.
+    """
+    with open(out_filename, "wb") as out_file:
+        size = os.fstat(in_file.fileno()).st_size
+        copy_range(in_file.fileno(), out_file.fileno(), 0, offset)
+        out_file.seek(offset)
+        out_file.write(data)
+        out_file.flush()
+        copy_range(in_file.fileno(), out_file.fileno(), offset, size - offset)
+
+
+def write_patches(out_file, patches):
+    """
+    Overwrite the bytes at each (offset, data) in patches in out_file.
+    """
+    for offset, data in patches:
+        out_file.seek(offset)
+        out_file.write(data)
+
+
+def insert_data(in_file, out_filename, offset, data, patches=()):
+    """
+    Insert data at offset in in_file.
+    patches is a list of (offset, data) to overwrite (same length) at offsets before the insertion offset, e.g. to fix up size fields.
+    If out_filename is given the result is written to out_filename and in_file is left unchanged,
+    otherwise in_file (opened "r+b") is changed in place.
+    """
+    if out_filename:
+        write_with_insert(in_file, out_filename, offset, data)
+        if patches:
+            with open(out_filename, "r+b") as out_file:
+                write_patches(out_file, patches)
+    else:
+        write_patches(in_file, patches)
+        insert_bytes(in_file, offset, data)
+
+
+def write_edit(buf, out_filename, offset, data, patches=()):
+    """
+    Write buf (the content of the source file, e.g. a mmap) to out_filename with data inserted at offset and patches applied.
+    Slices of buf are written directly, without copying them.
+    """
+    view = memoryview(buf)
+    with open(out_filename, "wb") as out_file:
+        pos = 0
+        for patch_offset, patch_data in sorted(patches):
+            out_file.write(view[pos:patch_offset])
+            out_file.write(patch_data)
+            pos = patch_offset + len(patch_data)
+        out_file.write(view[pos:offset])
+        out_file.write(data)
+        out_file.write(view[offset:])
+    view.release()
 
 
 def make_rtext():
@@ -16,7 +153,29 @@ def make_rtext():
     return "{0:09d}".format(random.randint(0,999999999))
 
 
-def is_png(png_filename):
+def detect_format(header):
+    """
+    Identify the format of a file from the first bytes of the file (header) by their magic bytes.
+
+    Return "png", "gif" (GIF89a), "gif87a", "jpeg", "ebml" (mkv / webm), "isobmff" (mp4 / mov),
+    or None if the format isn't recognized.
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header.startswith(b"GIF89a"):
+        return "gif"
+    if header.startswith(b"GIF87a"):
+        return "gif87a"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x1a\x45\xdf\xa3"):
+        return "ebml"
+    if header[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide", b"skip"):
+        return "isobmff"
+    return None
+
+
+def is_png(header):
     """
     Check if the file begins with the PNG signature.
 
@@ -27,28 +186,20 @@ def is_png(png_filename):
     """
     PNG_SIG = b"\x89\x50\x4e\x47\x0d\x0a\x1a\x0a" # png signature
     PNG_SIG_LEN = 8
-    try:
-        with open(png_filename, "rb") as png_file:
-            sig = png_file.read(PNG_SIG_LEN)
-            if sig == PNG_SIG:
-                return PNG_SIG_LEN
-            else:
-                return None
-    except:
+    if header[:PNG_SIG_LEN] == PNG_SIG:
+        return PNG_SIG_LEN
+    else:
         return None
     
 
-def get_png_ihdr_size(png_filename, ihdr_offset):
+def get_png_ihdr_size(header, ihdr_offset):
     """
     Return the size in bytes of the PNG IHDR chunk.
     """
     CHUNK_FIELD_LEN = 4 # size in bytes for the length, chunk type, & crc fields
-    ihdr_size = None
-    with open(png_filename, "rb") as png_file:
-        png_file.seek(ihdr_offset)
-        # read the length field of IHDR chunk, which represents the length of the chunk data field
-        ihdr_data_len = png_file.read(CHUNK_FIELD_LEN)
-        ihdr_size = (3 * CHUNK_FIELD_LEN) + int.from_bytes(ihdr_data_len, byteorder="big")
+    # read the length field of IHDR chunk, which represents the length of the chunk data field
+    ihdr_data_len = header[ihdr_offset:ihdr_offset + CHUNK_FIELD_LEN]
+    ihdr_size = (3 * CHUNK_FIELD_LEN) + int.from_bytes(ihdr_data_len, byteorder="big")
     assert(ihdr_size <= (2**31) - 1) # max chunk size
     return ihdr_size
 
@@ -70,20 +221,19 @@ def make_png_text_chunk():
     return CHUNK_DATA_LENGTH + CHUNK_TYPE + CHUNK_DATA + CHUNK_CRC
 
 
-def rehash_png(png_filename):
+def plan_png(png_file, header):
     """
-    Write a tEXt chunk in the png file to change the file hash
+    Plan writing a tEXt chunk in the png file to change the file hash (after the IHDR chunk).
+
+    png_file is the open file, header the first bytes read from it.
+    Return an edit function (see do_rehash).
     """
-    ihdr_beg = is_png(png_filename)
-    if ihdr_beg:
-        ihdr_len = get_png_ihdr_size(png_filename, ihdr_beg)
-        with open(png_filename, "r+b") as png_file:
-            png_file.seek(ihdr_beg + ihdr_len)
-            data = png_file.read()
-            png_file.seek(ihdr_beg + ihdr_len)
-            png_file.write(make_png_text_chunk())
-            png_file.write(data)
-            png_file.truncate()
+    MESSAGE_PNG_SIG_ERROR = "file doesn't begin with the png signature..."
+    ihdr_beg = is_png(header)
+    if not ihdr_beg:
+        raise RehashError(MESSAGE_PNG_SIG_ERROR)
+    ihdr_len = get_png_ihdr_size(header, ihdr_beg)
+    return lambda: (ihdr_beg + ihdr_len, make_png_text_chunk(), ())
 
 
 # def rehash_png(png_filename):
@@ -100,44 +250,65 @@ def rehash_png(png_filename):
 #         writer.write(out_file, pix)
 
 
-# def writeExifComment(filename,comment):
+def get_jpg_com_offset(jpg_file):
+    """
+    Return the offset to the first position where writing a COM (comment) segment is valid.
+
+    Walks the marker segments after SOI and returns the offset after the leading APPn segments (JFIF APP0,
+    Exif APP1, ...), which must stay at the beginning of the file.  Only the 4 byte segment headers are read.
+
+    Return None if the segments can't be walked (not a valid jpg file).
+    """
+    SOI_LEN = 2
+    offset = SOI_LEN
+    while True:
+        jpg_file.seek(offset)
+        marker = jpg_file.read(4)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] == 0xff:
+            offset += 1 # fill byte before a marker
+            continue
+        if not (0xe0 <= marker[1] <= 0xef) or len(marker) < 4:
+            return offset
+        # APPn segment, its length field counts itself but not the marker
+        offset += 2 + int.from_bytes(marker[2:4], byteorder="big")
 
-#     im = Image.open(filename)
-#     fileExtension = os.path.splitext(filename)[1]
-#     exif_dict = piexif.load(im.info["exif"])
-#     exif_dict["Exif"][piexif.ExifIFD.UserComment] = comment
-#     exif_bytes = piexif.dump(exif_dict)
-#     im.save(filename, 'jpeg', exif=exif_bytes)
-#     im.close()
 
-def rehash_jpg(jpg_filename):
+def make_jpg_com_segment():
     """
-    Write ExifIFD.UserComment in jpg exif to change the file hash    
+    Return a COM (comment) segment to write to a jpg file.
     """
-    MESSAGE_JPG_INSERT_ERROR = "couldn't insert UserComment for this image..."
-    exif_IFD = {piexif.ExifIFD.UserComment: str.encode("rehash: " + make_rtext())}
-    # exif_IFD = {piexif.ImageIFD.ImageDescription: "abcdefghijklmnopqrstuvwxyz0123456789"}
-    exif_dict = {"Exif":exif_IFD}
-    exif_bytes = piexif.dump(exif_dict)
-    try:
-        piexif.insert(exif_bytes, jpg_filename)
-    except piexif.InvalidImageDataError:
-        print(MESSAGE_JPG_INSERT_ERROR)
+    comment = str.encode("rehash: " + make_rtext())
+    return b"\xff\xfe" + (len(comment) + 2).to_bytes(2, byteorder="big") + comment
+
+
+def plan_jpg(jpg_file, header):
+    """
+    Plan inserting a COM segment in the jpg file to change the file hash.
+
+    jpg_file is the open file, header the first bytes read from it.
+    Return an edit function (see do_rehash).
+    """
+    MESSAGE_JPG_INSERT_ERROR = "couldn't find where to insert a comment segment in this image..."
+    com_offset = get_jpg_com_offset(jpg_file)
+    if com_offset is None:
+        raise RehashError(MESSAGE_JPG_INSERT_ERROR)
+    return lambda: (com_offset, make_jpg_com_segment(), ())
 
 
-def check_gif_vs_support(gif_filename):
+def check_gif_vs_support(header):
     """
     Confirm gif file version is "GIF89a" so comment blocks are supported
     """
     GIF_HEADER_BYTES = 6
-    with open(gif_filename, "rb") as in_file:
-        if in_file.read(GIF_HEADER_BYTES) != b"GIF89a":
-            return False
-        else:
-            return True
+    if header[:GIF_HEADER_BYTES] != b"GIF89a":
+        return False
+    else:
+        return True
 
 
-def get_cblock_offset(gif_filename):
+def get_cblock_offset(header):
     """
     Return the offset to the first position where writing a comment block is valid.
     This is immediately after the Global Color Table, if present.
@@ -146,69 +317,184 @@ def get_cblock_offset(gif_filename):
     GIF_LSD_BYTES = 7 # 7 bytes, logical screen descriptor
     GIF_PF_OFFSET = 10 # offset bytes to the packed field byte, 6 byte header + 4 bytes (logical screen width & height)
     offset = GIF_HEADER_BYTES + GIF_LSD_BYTES # Header bytes + Logical Screen Descriptor
-    with open(gif_filename, "rb") as gif_file:
-        gif_file.seek(GIF_PF_OFFSET)
-        packed_field = gif_file.read(1)
-        pf_int = int.from_bytes(packed_field, byteorder="big")
-        if(pf_int >> 7 == 1):
-            # Global Color Table exists, increase offset by the size of the GCT
-            mask = ~(((1 << 5) - 1) << 3) # mask (00000111) to extract GCT size
-            gct_bytes = 3 * 2**((pf_int & mask) + 1)
-            assert(gct_bytes >= 6 and gct_bytes <= 768) # min gct size, max gct size
-            offset += gct_bytes
+    packed_field = header[GIF_PF_OFFSET:GIF_PF_OFFSET + 1]
+    pf_int = int.from_bytes(packed_field, byteorder="big")
+    if(pf_int >> 7 == 1):
+        # Global Color Table exists, increase offset by the size of the GCT
+        mask = ~(((1 << 5) - 1) << 3) # mask (00000111) to extract GCT size
+        gct_bytes = 3 * 2**((pf_int & mask) + 1)
+        assert(gct_bytes >= 6 and gct_bytes <= 768) # min gct size, max gct size
+        offset += gct_bytes
     return offset
 
 
-def insert_gif_comment(gif_filename):
+def make_gif_comment_block():
     """
-    Insert comment block in the specified gif file
+    Return a comment extension block to write to a gif file.
     """
-    if not check_gif_vs_support(gif_filename):
-        MESSAGE_GIF_VERSION_ERROR = "gif version is not supported (gif version must be \"GIF89a\" to support comment blocks)... try updating gif file version?"
-        print(MESSAGE_GIF_VERSION_ERROR)
-        return
-    else:
-        comment = "rehash: " + make_rtext()
-        with open(gif_filename, "r+b") as gif_file:
-            comment_offset = get_cblock_offset(gif_filename)
-            gif_file.seek(comment_offset)
-            data = gif_file.read()
-            # insert comment block
-            gif_file.write(b"\x21") # extension introducer
-            gif_file.write(b"\xfe") # comment label
-            gif_file.write(str.encode(chr(len(comment)))) # data size
-            gif_file.write(str.encode(comment)) # comment data
-            gif_file.write(b"\x00") # block terminator
-            # write remaining image data
-            gif_file.write(data)
-            gif_file.truncate()
-
-
-def rehash_gif(gif_filename):
-    """
-    Rehash specified gif file
+    comment = "rehash: " + make_rtext()
+    return (b"\x21" # extension introducer
+            + b"\xfe" # comment label
+            + str.encode(chr(len(comment))) # data size
+            + str.encode(comment) # comment data
+            + b"\x00" # block terminator
+    )
+
+
+def plan_gif(gif_file, header):
     """
+    Plan inserting a comment block in the specified gif file (after the Global Color Table, if present).
+
+    gif_file is the open file, header the first bytes read from it.
+    Return an edit function (see do_rehash).
+    """
+    MESSAGE_GIF_VERSION_ERROR = "gif version is not supported (gif version must be \"GIF89a\" to support comment blocks)... try updating gif file version?"
     MESSAGE_GIF_INSERT_ERROR = "error occurred while inserting comment block in gif file"
+    if not check_gif_vs_support(header):
+        raise RehashError(MESSAGE_GIF_VERSION_ERROR)
     try:
-        insert_gif_comment(gif_filename)
-    except:
-        print(MESSAGE_GIF_INSERT_ERROR)
-        return
+        comment_offset = get_cblock_offset(header)
+    except Exception:
+        raise RehashError(MESSAGE_GIF_INSERT_ERROR)
+    return lambda: (comment_offset, make_gif_comment_block(), ())
+
+
+def get_last_mp4_box(mp4_file, size):
+    """
+    Walk the top level boxes of an mp4 / mov (ISO-BMFF) file of size bytes, reading only the box headers.
+
+    Return a tuple (offset, box size, box type, size field length) for the last top level box.
+    A box size of 0 means the box extends to the end of the file.
+
+    Return None if the boxes don't add up to the file size (not a valid file).
+    """
+    BOX_HEADER_LEN = 8
+    offset = 0
+    last = None
+    while offset < size:
+        mp4_file.seek(offset)
+        box_header = mp4_file.read(BOX_HEADER_LEN)
+        if len(box_header) < BOX_HEADER_LEN:
+            return None
+        box_size = int.from_bytes(box_header[:4], byteorder="big")
+        box_type = box_header[4:8]
+        size_len = 4
+        if box_size == 1:
+            # 64 bit largesize follows the box type
+            box_size = int.from_bytes(mp4_file.read(8), byteorder="big")
+            size_len = 12
+        last = (offset, box_size, box_type, size_len)
+        if box_size == 0:
+            return last
+        if box_size < BOX_HEADER_LEN:
+            return None
+        offset += box_size
+    if offset != size:
+        return None
+    return last
+
+
+def make_mp4_free_box():
+    """
+    Return a free box to write to an mp4 / mov file.
+    """
+    comment = str.encode("rehash: " + make_rtext())
+    return (8 + len(comment)).to_bytes(4, byteorder="big") + b"free" + comment
 
 
-def rehash_mp4(mp4_filename):
+def plan_mp4(mp4_file, header):
     """
-    Mutate the meta data in a .mp4 file to change the file hash    
+    Plan appending a top level free box to the mp4 / mov file to change the file hash.
+
+    Appending doesn't move moov or mdat, so no chunk offsets need rewriting and the cost doesn't depend on the file size.
+    If the last box is a free box written by a previous rehash, it is overwritten instead, so the file doesn't grow.
+
+    mp4_file is the open file, header the first bytes read from it.
+    Return an edit function (see do_rehash).
     """
-    print("rehash_mp4()")
+    MESSAGE_MP4_BOX_ERROR = "couldn't walk the top level boxes of this file..."
+    MESSAGE_MP4_SIZE_ERROR = "the last box extends to the end of the file and is too large to append after..."
+    size = os.fstat(mp4_file.fileno()).st_size
+    last = get_last_mp4_box(mp4_file, size)
+    if last is None:
+        raise RehashError(MESSAGE_MP4_BOX_ERROR)
+    box_len = len(make_mp4_free_box())
+    last_offset, last_size, last_type, size_len = last
+    if last_type == b"free" and last_size == box_len:
+        mp4_file.seek(last_offset + 8)
+        if mp4_file.read(8) == b"rehash: ":
+            return lambda: (size, b"", [(last_offset, make_mp4_free_box())])
+    patches = []
+    if last_size == 0:
+        # the last box extends to the end of the file; give it an explicit size so the free box isn't inside it
+        if size_len != 4 or size - last_offset > 0xffffffff:
+            raise RehashError(MESSAGE_MP4_SIZE_ERROR)
+        patches.append((last_offset, (size - last_offset).to_bytes(4, byteorder="big")))
+    return lambda: (size, make_mp4_free_box(), patches)
+
 
+EBML_ID_EBML = b"\x1a\x45\xdf\xa3"
+EBML_ID_SEGMENT = b"\x18\x53\x80\x67"
+EBML_ID_CLUSTER = b"\x1f\x43\xb6\x75"
+EBML_ID_VOID = b"\xec"
+EBML_ID_TAGS = b"\x12\x54\xc3\x67"
 
-def rehash_ebml(ebml_filename):
+
+def encode_ebml_size(size, width=None):
     """
-    Write a tag segment at the end of the specified ebml container
+    Return size encoded as an EBML variable length integer, width bytes long (the shortest width that fits if None).
+    The all ones value of each width is reserved (unknown size), so a width w holds sizes up to 2^(7w) - 2.
+    """
+    if width is None:
+        width = 1
+        while size > (1 << (7 * width)) - 2:
+            width += 1
+    assert(width <= 8 and size <= (1 << (7 * width)) - 2)
+    return ((1 << (7 * width)) | size).to_bytes(width, byteorder="big")
+
+
+def read_ebml_element_header(ebml_file, offset):
+    """
+    Read the header (ID and size) of the EBML element at offset.
+
+    Return a tuple (id, size, header length), size is None if the element size is unknown.
+    Return None if there isn't a valid element header at offset.
+    """
+    ebml_file.seek(offset)
+    data = ebml_file.read(12) # max 4 byte ID + max 8 byte size
+    if not data or data[0] == 0:
+        return None
+    id_len = 1
+    while not data[0] & (0x80 >> (id_len - 1)):
+        id_len += 1
+    if id_len > 4 or len(data) <= id_len or data[id_len] == 0:
+        return None
+    size_len = 1
+    while not data[id_len] & (0x80 >> (size_len - 1)):
+        size_len += 1
+    if len(data) < id_len + size_len:
+        return None
+    size = data[id_len] & ((0x80 >> (size_len - 1)) - 1)
+    for b in data[id_len + 1:id_len + size_len]:
+        size = (size << 8) | b
+    if size == (1 << (7 * size_len)) - 1:
+        size = None # unknown size
+    return data[:id_len], size, id_len + size_len
+
+
+def make_ebml_element(element_id, data, size_width=None):
+    """
+    Return an EBML element with ID element_id and content data.
+    """
+    return element_id + encode_ebml_size(len(data), size_width) + data
+
+
+def make_ebml_tags(pad=0):
+    """
+    Return a Tags element holding a single COMMENT SimpleTag to write to an ebml container.
+    pad widens the size field of the Tags element by pad bytes (to fill a space of a given size exactly).
     """
     comment = "rehash: " + make_rtext()
-    ebml_id_tags = b"\x12\x54\xc3\x67"
     ebml_id_tag = b"\x73\x73"
     ebml_id_targets = b"\x63\xc0"
     ebml_id_simple_tag = b"\x67\xc8"
@@ -218,99 +504,291 @@ def rehash_ebml(ebml_filename):
     ebml_id_tag_string = b"\x44\x87"
     tag_name = b"COMMENT"
     tag_language = b"eng"
-    tag_segment = (ebml_id_tags
-                   + ebml_id_tag
-                   + ebml_id_targets
-                   + ebml_id_simple_tag
-                   + (ebml_id_tag_name + tag_name)
-                   + (ebml_id_tag_language + tag_language)
-                   + ebml_id_tag_default
-                   + (ebml_id_tag_string + str.encode(comment))
+    simple_tag = make_ebml_element(ebml_id_simple_tag,
+                                   make_ebml_element(ebml_id_tag_name, tag_name)
+                                   + make_ebml_element(ebml_id_tag_language, tag_language)
+                                   + make_ebml_element(ebml_id_tag_default, b"\x01")
+                                   + make_ebml_element(ebml_id_tag_string, str.encode(comment))
     )
-    with open(ebml_filename, "ab") as ebml_file:
-        ebml_file.write(tag_segment)
-
-
-def do_rehash(filename, ext):
-    """
-    Call the appropriate rehash function for the file extension.
-    """
-    if ext == "png":
-        rehash_png(filename)
-    elif ext == "jpg":
-        rehash_jpg(filename)
-    elif ext == "jpeg":
-        rehash_jpg(filename)
-    elif ext == "gif":
-        rehash_gif(filename)
-    elif ext == "webm":
-        rehash_ebml(filename)
-    elif ext == "mkv":
-        rehash_ebml(filename)
-    elif ext == "mp4":
-        rehash_mp4(filename)
-    else:
-        pass
+    tag = make_ebml_element(ebml_id_tag, make_ebml_element(ebml_id_targets, b"") + simple_tag)
+    return make_ebml_element(EBML_ID_TAGS, tag, len(encode_ebml_size(len(tag))) + pad)
 
 
-def is_filetype_supported(filename):
+def make_ebml_void(size):
     """
-    Check if a file type is valid and supported by rehash.
-    If true, return the file extension.
+    Return a Void element exactly size bytes long (size must not be 1).
     """
-    MESSAGE_NO_FILE = "is not a valid file."
-    MESSAGE_FILE_EXT_UNKNOWN = "couldn't determine the file type... check file extension?"
-    MESSAGE_FILE_EXT_UNSUPPORTED = "file type is unsupported."
-    
-    if not os.path.isfile(filename):
-        print(filename + " " + MESSAGE_NO_FILE)
-        return None
-    
-    # get the filename file extension and compare to supported extensions
-    FILETYPES = ("png", "jpg", "jpeg", "gif", "webm", "mkv")
-    
-    ext_split = os.path.splitext(filename)
-    file_ext = ext_split[1]
-    if (not file_ext) or file_ext == os.path.extsep:
-        print(MESSAGE_FILE_EXT_UNKNOWN)
-        return None
-    file_ext = (file_ext[1:]).lower() # remove extension separator, make extension lower
-    if file_ext not in FILETYPES:
-        print(MESSAGE_FILE_EXT_UNSUPPORTED)
-        return None
-    # filetype is known and supported
-    return file_ext
-    
+    if size == 0:
+        return b""
+    assert(size >= 2)
+    if size - 2 <= 126:
+        return make_ebml_element(EBML_ID_VOID, bytes(size - 2), 1)
+    return make_ebml_element(EBML_ID_VOID, bytes(size - 9), 8)
+
 
-def get_rehash_filename(filename):
+def is_rehash_tags(ebml_file, offset, size):
+    """
+    Check if the element of size bytes at offset is a Tags element written by rehash.
+    """
+    ebml_file.seek(offset)
+    data = ebml_file.read(size)
+    return data.startswith(EBML_ID_TAGS) and b"rehash: " in data
+
+
+def fill_ebml_void(void_size):
+    """
+    Return a Tags element followed by a Void element, together exactly void_size bytes long,
+    or None if a Tags element doesn't fit in void_size bytes.
+    """
+    tags_len = len(make_ebml_tags())
+    if void_size == tags_len + 1:
+        return make_ebml_tags(1)
+    if void_size < tags_len:
+        return None
+    return make_ebml_tags() + make_ebml_void(void_size - tags_len)
+
+
+def plan_ebml(ebml_file, header):
+    """
+    Plan writing a Tags element in the Segment of the specified ebml container to change the file hash.
+
+    The Segment's children are walked (headers only) up to the first Cluster:
+    -a Tags element written by a previous rehash is overwritten in place
+    -otherwise the Tags element is written over (the start of) a Void element (padding left by the muxer)
+    both are O(1) writes and the file doesn't grow.
+    Only if there is no room, the Tags element is appended to the end of the Segment (and the Segment size updated).
+
+    ebml_file is the open file, header the first bytes read from it.
+    Return an edit function (see do_rehash).
+    """
+    MESSAGE_EBML_SEGMENT_ERROR = "couldn't find the segment in this file..."
+    MESSAGE_EBML_APPEND_ERROR = "no padding to write tags into, and the segment doesn't end at the end of the file..."
+    file_size = os.fstat(ebml_file.fileno()).st_size
+    # find the segment, after the EBML header element
+    offset = 0
+    segment = None
+    while offset < file_size:
+        element = read_ebml_element_header(ebml_file, offset)
+        if element is None:
+            break
+        element_id, size, header_len = element
+        if element_id == EBML_ID_SEGMENT:
+            segment = (offset, size, header_len)
+            break
+        if size is None:
+            break
+        offset += header_len + size
+    if segment is None:
+        raise RehashError(MESSAGE_EBML_SEGMENT_ERROR)
+    segment_offset, segment_size, segment_header_len = segment
+    segment_data = segment_offset + segment_header_len
+    segment_end = file_size if segment_size is None else segment_data + segment_size
+
+    tags_len = len(make_ebml_tags())
+    # a Tags element appended by a previous rehash
+    if segment_end == file_size and segment_end - tags_len >= segment_data and is_rehash_tags(ebml_file, segment_end - tags_len, tags_len):
+        return lambda: (file_size, b"", [(segment_end - tags_len, make_ebml_tags())])
+    # walk the segment's children up to the first cluster
+    offset = segment_data
+    while offset < segment_end:
+        element = read_ebml_element_header(ebml_file, offset)
+        if element is None:
+            break
+        element_id, size, header_len = element
+        if element_id == EBML_ID_CLUSTER or size is None:
+            break
+        element_len = header_len + size
+        # (a Tags element filling a Void one byte longer than it has its size field widened by a byte, see fill_ebml_void)
+        if element_id == EBML_ID_TAGS and element_len in (tags_len, tags_len + 1) and is_rehash_tags(ebml_file, offset, element_len):
+            tags_offset = offset
+            tags_pad = element_len - tags_len
+            return lambda: (file_size, b"", [(tags_offset, make_ebml_tags(tags_pad))])
+        if element_id == EBML_ID_VOID:
+            if fill_ebml_void(element_len) is not None:
+                void_offset = offset
+                return lambda: (file_size, b"", [(void_offset, fill_ebml_void(element_len))])
+        offset += element_len
+
+    # no padding, append the Tags element to the end of the segment
+    if segment_end != file_size:
+        raise RehashError(MESSAGE_EBML_APPEND_ERROR)
+    patches = []
+    if segment_size is not None:
+        size_width = segment_header_len - len(EBML_ID_SEGMENT)
+        if segment_size + tags_len > (1 << (7 * size_width)) - 2:
+            raise RehashError(MESSAGE_EBML_APPEND_ERROR)
+        patches.append((segment_offset + len(EBML_ID_SEGMENT), encode_ebml_size(segment_size + tags_len, size_width)))
+    return lambda: (file_size, make_ebml_tags(), patches)
+
+
+REHASH_FUNCTIONS = {
+    "png": plan_png,
+    "jpeg": plan_jpg,
+    "gif": plan_gif,
+    "gif87a": plan_gif, # plan_gif reports the version isn't supported
+    "ebml": plan_ebml,
+    "isobmff": plan_mp4,
+} # function planning the rehash of each supported format (see detect_format)
+
+
+def do_rehash(in_file, header, file_format, out_filename=None):
+    """
+    Rehash in_file with the appropriate function for the file format.
+    If out_filename is given the rehashed file is written there, otherwise in_file is overwritten.
+
+    The format functions only work out where the file has to change; they return an edit function which,
+    each time it's called, makes new metadata (with a new make_rtext) and returns a tuple (offset, data, patches):
+    data is inserted at offset, and patches is a list of (offset, data) overwritten before it.
+    """
+    edit = REHASH_FUNCTIONS[file_format](in_file, header)
+    insert_data(in_file, out_filename, *edit())
+
+
+def do_rehash_variants(in_file, header, file_format, out_filenames):
+    """
+    Write a distinct rehashed copy of in_file to each of out_filenames.
+
+    in_file is read once (memory mapped) and shared by all of the copies; each copy gets its own metadata.
+    """
+    edit = REHASH_FUNCTIONS[file_format](in_file, header)
+    edits = []
+    seen = set()
+    while len(edits) < len(out_filenames):
+        offset, data, patches = edit()
+        key = (data, tuple(patches))
+        if key not in seen: # make_rtext is random, make sure no two copies are the same
+            seen.add(key)
+            edits.append((offset, data, patches))
+    with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for out_filename, (offset, data, patches) in zip(out_filenames, edits):
+            write_edit(buf, out_filename, offset, data, patches)
+
+
+def get_filetype(in_file):
+    """
+    Read the header of in_file and detect the file format from it.
+    If the format is supported, return a tuple (header, format), otherwise raise RehashError.
+    """
+    MESSAGE_FILE_TYPE_UNKNOWN = "couldn't determine the file type from its header..."
+    MESSAGE_FILE_TYPE_UNSUPPORTED = "file type is unsupported."
+    header = in_file.read(HEADER_SIZE)
+    file_format = detect_format(header)
+    if file_format is None:
+        raise RehashError(MESSAGE_FILE_TYPE_UNKNOWN)
+    if file_format not in REHASH_FUNCTIONS:
+        raise RehashError(MESSAGE_FILE_TYPE_UNSUPPORTED)
+    return header, file_format
+
+
+def get_rehash_filename(filename, variant=None):
     """
     Return the filename rehash will write to if NOT overwriting filename.
+    (with --variants, variant is the number of the copy)
     """
     pname, fname = os.path.split(filename)
-    return os.path.join(pname, "rehash_" + fname)    
-    
-    
+    if variant is not None:
+        return os.path.join(pname, REHASH_PREFIX + str(variant) + "_" + fname)
+    return os.path.join(pname, REHASH_PREFIX + fname)    
+
+
+def find_files(paths, recursive, overwrite):
+    """
+    Return the list of files to rehash.
+
+    If recursive, directories in paths are searched recursively for files with a supported extension.
+    (when NOT overwriting, files written by a previous run, beginning with REHASH_PREFIX, are skipped)
+    Other paths are returned as given.
+    """
+    filenames = []
+    for path in paths:
+        if recursive and os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    if not overwrite and f.startswith(REHASH_PREFIX):
+                        continue
+                    if os.path.splitext(f)[1][1:].lower() in FILETYPES:
+                        filenames.append(os.path.join(root, f))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def rehash_file(filename, overwrite, variants=0):
+    """
+    Rehash a single file, overwriting it or writing to get_rehash_filename(filename).
+    If variants is given, write that many distinct copies instead (see do_rehash_variants).
+
+    Return a tuple (filename, bytes processed, error message).
+    Any error is caught and returned as the error message (None if the file was rehashed), so one bad file
+    doesn't stop a batch.
+    """
+    MESSAGE_NO_FILE = "is not a valid file."
+    try:
+        if not os.path.isfile(filename):
+            raise RehashError(MESSAGE_NO_FILE)
+        # the file is opened once; its header and handle are passed to the format specific writer
+        with open(filename, "r+b" if overwrite else "rb") as in_file:
+            size = os.fstat(in_file.fileno()).st_size
+            header, file_format = get_filetype(in_file)
+            if variants:
+                do_rehash_variants(in_file, header, file_format, [get_rehash_filename(filename, i) for i in range(1, variants + 1)])
+            elif overwrite:
+                do_rehash(in_file, header, file_format)
+            else:
+                do_rehash(in_file, header, file_format, get_rehash_filename(filename))
+        return filename, size, None
+    except RehashError as e:
+        return filename, 0, str(e)
+    except Exception as e:
+        return filename, 0, "{0}: {1}".format(type(e).__name__, e)
+
+
+def rehash_worker(job):
+    return rehash_file(*job)
+
+
+def do_report(results, seconds):
+    """
+    Print a summary of a run: files rehashed, bytes processed, throughput and any failures.
+    """
+    failures = [(fname, error) for fname, size, error in results if error]
+    done = len(results) - len(failures)
+    total_bytes = sum(size for fname, size, error in results)
+    rate = (done / seconds) if seconds > 0 else 0
+    print("rehashed {0} of {1} files ({2:.1f} MB) in {3:.2f} s ({4:.1f} files/s)".format(done, len(results), total_bytes / (1 << 20), seconds, rate))
+    if failures:
+        print("\n{0} failed:".format(len(failures)))
+        for fname, error in sorted(failures):
+            print(fname + ": " + error)
+
+
 def main(argv):
     """
     """
     parser = argparse.ArgumentParser(description="Change the hash of a file.")
     parser.add_argument("-o", help="overwrite (write output to input file)", action="store_true")
+    parser.add_argument("-r", help="recursive (rehash supported files found in directories)", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes (default 1, 0 uses all cpus)")
+    parser.add_argument("--variants", type=int, default=0, metavar="N", help="write N distinct copies of each file (reads each file once)")
     parser.add_argument("filenames", nargs="+", help="change the hash of these file(s)")
     args = parser.parse_args(argv[1:])
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if args.variants and args.o:
+        parser.error("--variants can't be used with -o")
     
-    filenames = args.filenames
-    for fname in filenames:
-        # print(fname)
-        file_ext = is_filetype_supported(fname)
-        if file_ext:
-            if not args.o:
-                new_fname = get_rehash_filename(fname)
-                copyfile(fname, new_fname)
-                fname = new_fname
-            do_rehash(fname, file_ext)
-        else:
-            pass
+    filenames = find_files(args.filenames, args.r, args.o)
+    jobs_list = [(fname, args.o, args.variants) for fname in filenames]
+    start = time.perf_counter()
+    if jobs > 1 and len(jobs_list) > 1:
+        # reseed in each worker, forked workers would otherwise share the random state and write the same rtext
+        with multiprocessing.Pool(min(jobs, len(jobs_list)), initializer=random.seed) as pool:
+            results = list(pool.imap_unordered(rehash_worker, jobs_list))
+    else:
+        results = [rehash_worker(job) for job in jobs_list]
+    do_report(results, time.perf_counter() - start)
+    return 1 if any(error for fname, size, error in results) else 0
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,263 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark rehash.py on synthetic inputs of increasing size.
+
+Inputs are made from the samples in rehash/test by padding them up to each requested size with data rehash has to
+carry along (so the files stay valid):
+  -png: private ancillary chunks before IEND
+  -gif: a comment extension before the trailer
+  -jpg: COM segments before EOI
+  -webm: a Void element appended to the Segment (the Segment size is updated)
+
+Each format and size is rehashed in copy mode and then in place (-o), each run in its own process so its
+wall time, syscall counts (from /proc/self/io, Linux only) and peak RSS can be measured.
+Results are appended to a JSON lines file, one record per run, so runs of different versions can be compared.
+"""
+
+import sys
+import os
+import argparse
+import json
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import zlib
+import multiprocessing
+from datetime import datetime, timezone
+
+import rehash
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "test")
+SAMPLES = {"png": "test.png", "gif": "test.gif", "jpg": "test.jpg", "webm": "test.webm"}
+PAD_CHUNK_SIZE = 1 << 20 # padding is written in chunks of this size, so making a large input doesn't use much memory
+MODES = [("copy", False), ("inplace", True)]
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(size):
+    """
+    Parse a size like "100K", "10M" or "2G" (or a plain number of bytes).
+    """
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def write_padding(out_file, length, make_block, block_len):
+    """
+    Write length bytes of padding to out_file as a run of make_block(n) blocks, each at most block_len bytes long.
+    make_block(n) returns a block n bytes long; blocks of the same length are only made once.
+    """
+    blocks = {}
+    while length > 0:
+        n = min(length, block_len)
+        if n not in blocks:
+            blocks[n] = make_block(n)
+        out_file.write(blocks[n])
+        length -= n
+
+
+def make_png_pad_chunk(n):
+    """
+    Return a private ancillary png chunk n bytes long (including the 12 bytes of length, type and CRC).
+    """
+    chunk_type = b"rbPd" # ancillary, private, safe to copy
+    data = bytes(n - 12)
+    return (len(data).to_bytes(4, byteorder="big") + chunk_type + data
+            + zlib.crc32(chunk_type + data).to_bytes(4, byteorder="big"))
+
+
+def pad_png(data, out_file, length):
+    IEND_LEN = 12
+    if data[-IEND_LEN + 4:-4] != b"IEND":
+        raise ValueError("png sample doesn't end with IEND")
+    out_file.write(data[:-IEND_LEN])
+    if length % PAD_CHUNK_SIZE < 12:
+        length -= length % PAD_CHUNK_SIZE # too short for a chunk of its own
+    write_padding(out_file, length, make_png_pad_chunk, PAD_CHUNK_SIZE)
+    out_file.write(data[-IEND_LEN:])
+
+
+def pad_gif(data, out_file, length):
+    if data[-1:] != b"\x3b":
+        raise ValueError("gif sample doesn't end with the trailer")
+    out_file.write(data[:-1])
+    if length >= 4:
+        # a single comment extension of 255 byte sub-blocks (the last may be shorter)
+        out_file.write(b"\x21\xfe")
+        sub_blocks = length - 3
+        block = b"\xff" + bytes(255)
+        write_padding(out_file, sub_blocks - sub_blocks % 256, lambda n: block * (n // 256), PAD_CHUNK_SIZE - PAD_CHUNK_SIZE % 256)
+        if sub_blocks % 256 > 1: # (1 byte left over is dropped, a sub-block can't be empty)
+            out_file.write(bytes([sub_blocks % 256 - 1]) + bytes(sub_blocks % 256 - 1))
+        out_file.write(b"\x00")
+    out_file.write(data[-1:])
+
+
+def pad_jpg(data, out_file, length):
+    if data[-2:] != b"\xff\xd9":
+        raise ValueError("jpg sample doesn't end with EOI")
+    out_file.write(data[:-2])
+    length = 0 if length < 4 else length
+    if length % 65537 in (1, 2, 3):
+        length -= length % 65537 # too short for a COM segment of its own
+    write_padding(out_file, length, lambda n: b"\xff\xfe" + (n - 2).to_bytes(2, byteorder="big") + bytes(n - 4), 65537)
+    out_file.write(data[-2:])
+
+
+def pad_webm(data, out_file, length):
+    with tempfile.TemporaryFile() as sample:
+        sample.write(data)
+        ebml = rehash.read_ebml_element_header(sample, 0)
+        segment_offset = ebml[1] + ebml[2]
+        segment = rehash.read_ebml_element_header(sample, segment_offset)
+    if segment is None or segment[0] != rehash.EBML_ID_SEGMENT:
+        raise ValueError("webm sample doesn't have a segment after the EBML header")
+    segment_id, segment_size, segment_header_len = segment
+    if segment_size is not None and segment_offset + segment_header_len + segment_size != len(data):
+        raise ValueError("webm sample segment doesn't end at the end of the file")
+    length = 0 if length < 9 else length
+    out_file.write(data[:segment_offset + len(segment_id)])
+    if segment_size is None:
+        out_file.write(data[segment_offset + len(segment_id):segment_offset + segment_header_len])
+    else:
+        out_file.write(rehash.encode_ebml_size(segment_size + length, segment_header_len - len(segment_id)))
+    out_file.write(data[segment_offset + segment_header_len:])
+    if length:
+        # one Void element with an 8 byte size
+        out_file.write(rehash.EBML_ID_VOID + rehash.encode_ebml_size(length - 9, 8))
+        write_padding(out_file, length - 9, bytes, PAD_CHUNK_SIZE)
+
+
+PAD_FUNCTIONS = {"png": pad_png, "gif": pad_gif, "jpg": pad_jpg, "webm": pad_webm}
+
+
+def make_input(fmt, size, filename):
+    """
+    Write the sample for fmt padded to about size bytes to filename.
+    (inputs smaller than the sample are the sample itself)
+
+    Return the size of the input file.
+    """
+    with open(os.path.join(SAMPLE_DIR, SAMPLES[fmt]), "rb") as in_file:
+        data = in_file.read()
+    with open(filename, "wb") as out_file:
+        PAD_FUNCTIONS[fmt](data, out_file, max(0, size - len(data)))
+    return os.path.getsize(filename)
+
+
+def read_proc_io():
+    """
+    Return the I/O counters of this process from /proc/self/io (rchar, wchar, syscr, syscw, ...),
+    or an empty dict if they aren't available.
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            return {k: int(v) for k, v in (line.split(":") for line in io_file)}
+    except OSError:
+        return {}
+
+
+def peak_rss_kb():
+    """
+    Return the peak RSS in KB of this process.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024 # ru_maxrss is in bytes on macOS
+    return rss
+
+
+def run_case(filename, overwrite, queue):
+    """
+    Rehash filename once (in a child process) and put the measurements on queue.
+    """
+    io_start = read_proc_io()
+    start = time.perf_counter()
+    filename, size, error = rehash.rehash_file(filename, overwrite)
+    seconds = time.perf_counter() - start
+    io_end = read_proc_io()
+    result = {"seconds": seconds, "error": error, "peak_rss_kb": peak_rss_kb()}
+    for counter in ("syscr", "syscw", "rchar", "wchar"):
+        result[counter] = io_end[counter] - io_start[counter] if counter in io_end else None
+    queue.put(result)
+
+
+def get_git_rev():
+    """
+    Return the git revision of the rehash.py being benchmarked, if it can be found.
+    """
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(rehash.__file__)), capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark rehash.py on synthetic inputs of increasing size.")
+    parser.add_argument("--formats", default=",".join(SAMPLES), help="formats to benchmark (default " + ",".join(SAMPLES) + ")")
+    parser.add_argument("--sizes", default="100K,10M,100M", help="input sizes, e.g. 100K,1G,4G (default 100K,10M,100M)")
+    parser.add_argument("--modes", default=",".join(mode for mode, overwrite in MODES), help="rehash modes (default copy,inplace)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to run each case (default 1)")
+    parser.add_argument("--dir", help="write the inputs in this directory and keep them (default: a temp directory that is removed)")
+    parser.add_argument("-o", "--output", default="rehash_bench.jsonl", help="JSON lines file results are appended to (default rehash_bench.jsonl)")
+    args = parser.parse_args(argv)
+
+    formats = [fmt.strip() for fmt in args.formats.split(",")]
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    modes = [(mode, overwrite) for mode, overwrite in MODES if mode in args.modes.split(",")]
+    for fmt in formats:
+        if fmt not in SAMPLES:
+            parser.error("unknown format: " + fmt)
+
+    root = args.dir or tempfile.mkdtemp(prefix="rehash_bench.")
+    ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    runs = []
+    try:
+        os.makedirs(root, exist_ok=True)
+        for fmt in formats:
+            for size in sizes:
+                filename = os.path.join(root, "bench_" + str(size) + "." + fmt)
+                print("generating " + filename + " ...")
+                input_bytes = make_input(fmt, size, filename)
+                # copy mode runs first, in place mode changes the input
+                for mode, overwrite in modes:
+                    for r in range(args.repeat):
+                        queue = ctx.Queue()
+                        proc = ctx.Process(target=run_case, args=(filename, overwrite, queue))
+                        proc.start()
+                        result = queue.get()
+                        proc.join()
+                        result.update({"format": fmt, "size": size, "bytes": input_bytes, "mode": mode, "run": r})
+                        result["mb_per_sec"] = input_bytes / (1 << 20) / result["seconds"] if result["seconds"] else None
+                        runs.append(result)
+                        print("{format:>5} {bytes:>12d} B {mode:>8}: {seconds:8.3f} s  {mb_per_sec:10.1f} MB/s  {syscr!s:>7} syscr  {syscw!s:>7} syscw  {peak_rss_kb:8d} KB peak rss".format(**result)
+                              + ("  error: " + result["error"] if result["error"] else ""))
+                        if not overwrite and os.path.exists(rehash.get_rehash_filename(filename)):
+                            os.remove(rehash.get_rehash_filename(filename))
+                if not args.dir:
+                    os.remove(filename)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "git_rev": get_git_rev(),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "params": {"formats": formats, "sizes": sizes, "modes": [mode for mode, overwrite in modes], "repeat": args.repeat},
+        "results": runs,
+    }
+    with open(args.output, "a") as out_file:
+        out_file.write(json.dumps(record) + "\n")
+    print("results appended to " + args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])